@@ -0,0 +1,154 @@
+import argparse
+import json
+import sys
+from dataclasses import asdict
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+from streamlit import logger as streamlit_logger
+
+import app
+
+# cache_resource and session-state calls warn on every use outside `streamlit run`
+streamlit_logger.set_log_level("error")
+
+class InvalidRequest(ValueError):
+    pass
+
+class APIResponse(JSONResponse):
+    def render(self, content):
+        return json.dumps(content, ensure_ascii=False, default=str).encode("utf-8")
+
+def weather_json(weather_data):
+    current_temp, current_emoji, forecast_data = app.summarize_forecast(weather_data)
+    return {"current_temp": current_temp, "current_emoji": current_emoji, "days": forecast_data}
+
+def city_param(request):
+    city = " ".join(request.query_params.get("city", "").split())
+    if not city:
+        raise InvalidRequest("city is required")
+    return city
+
+# Recommendation filters, validated the same way the search form constrains them
+def parse_preferences(body):
+    if not isinstance(body, dict):
+        raise InvalidRequest("request body must be a JSON object")
+    city = " ".join(str(body.get("city", "")).split())
+    if not city:
+        raise InvalidRequest("city is required")
+    difficulty = body.get("difficulty", app.DIFFICULTY_LEVELS[0])
+    if difficulty not in app.DIFFICULTY_LEVELS:
+        raise InvalidRequest(f"difficulty must be one of {', '.join(app.DIFFICULTY_LEVELS)}")
+    season = body.get("season", app.SEASONS[0])
+    if season not in app.SEASONS:
+        raise InvalidRequest(f"season must be one of {', '.join(app.SEASONS)}")
+    length = body.get("length_miles", 0.0)
+    elevation = body.get("elevation_feet", 0)
+    if isinstance(length, bool) or not isinstance(length, (int, float)) or not 0 <= length <= app.MAX_LENGTH_MILES:
+        raise InvalidRequest(f"length_miles must be a number between 0 and {app.MAX_LENGTH_MILES:g}")
+    if isinstance(elevation, bool) or not isinstance(elevation, int) or not 0 <= elevation <= app.MAX_ELEVATION_FEET:
+        raise InvalidRequest(f"elevation_feet must be an integer between 0 and {app.MAX_ELEVATION_FEET}")
+    pet_friendly = body.get("pet_friendly", False)
+    if not isinstance(pet_friendly, bool):
+        raise InvalidRequest("pet_friendly must be true or false")
+    user_preferences = body.get("user_preferences", "")
+    if not isinstance(user_preferences, str):
+        raise InvalidRequest("user_preferences must be a string")
+    return city, difficulty, float(length), elevation, season, pet_friendly, user_preferences
+
+def city_weather(city):
+    coordinates = app.geocode_city(city)
+    if coordinates is None:
+        return None, None
+    return coordinates, app.load_weather_data(*coordinates)
+
+def recommendations(preferences, include_weather):
+    summary, trails = app.generate_recommendation_results(*preferences)
+    results = [asdict(trail) for trail in trails]
+    if include_weather:
+        located = [(result, (trail.latitude, trail.longitude)) for result, trail in zip(results, trails) if trail.latitude is not None]
+        forecasts = app.get_weather_batch([location for _, location in located]) if located else []
+        for (result, _), weather_data in zip(located, forecasts):
+            result["weather"] = weather_json(weather_data) if weather_data else None
+    return {"city": preferences[0], "summary": summary, "trails": results}
+
+async def health(request):
+    return APIResponse({"status": "ok"})
+
+async def weather(request):
+    city = city_param(request)
+    coordinates, weather_data = await run_in_threadpool(city_weather, city)
+    if coordinates is None:
+        return APIResponse({"error": f"city not found: {city}"}, status_code=404)
+    if not weather_data:
+        return APIResponse({"error": "weather data unavailable"}, status_code=502)
+    latitude, longitude = coordinates
+    return APIResponse({"city": city, "latitude": latitude, "longitude": longitude, **weather_json(weather_data)})
+
+async def popular_trails(request):
+    city = city_param(request)
+    trails = await run_in_threadpool(app.generate_popular_trails, city, app.PRIORITY_INTERACTIVE)
+    return APIResponse({"city": city, "trails": [asdict(trail) for trail in trails]})
+
+async def recommend(request):
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise InvalidRequest("request body must be valid JSON")
+    preferences = parse_preferences(body)
+    include_weather = request.query_params.get("weather", "1") != "0"
+    return APIResponse(await run_in_threadpool(recommendations, preferences, include_weather))
+
+# Per worker process; scrape each worker or use METRICS_FILE with one file per worker
+async def metrics(request):
+    return PlainTextResponse(app.get_metrics().render_prometheus(), media_type="text/plain; version=0.0.4")
+
+async def bad_request(request, exc):
+    return APIResponse({"error": str(exc)}, status_code=400)
+
+async def overloaded(request, exc):
+    return APIResponse({"error": str(exc) or "model is overloaded, try again later"}, status_code=503, headers={"Retry-After": "60"})
+
+async def unparsed_response(request, exc):
+    return APIResponse({"error": str(exc), "text": exc.text}, status_code=502)
+
+async def upstream_error(request, exc):
+    return APIResponse({"error": f"upstream request failed: {exc}"}, status_code=502)
+
+def exception_handlers():
+    import requests
+    from geopy.exc import GeopyError
+    return {
+        InvalidRequest: bad_request,
+        app.LLMOverloaded: overloaded,
+        app.UnparsedResponse: unparsed_response,
+        requests.exceptions.RequestException: upstream_error,
+        GeopyError: upstream_error,
+    }
+
+api = Starlette(
+    routes=[
+        Route("/health", health),
+        Route("/weather", weather),
+        Route("/popular-trails", popular_trails),
+        Route("/recommendations", recommend, methods=["POST"]),
+        Route("/metrics", metrics),
+    ],
+    exception_handlers=exception_handlers(),
+)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the trail pipeline as a JSON API next to the Streamlit UI.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes; SQLite-backed caches are shared between them")
+    args = parser.parse_args()
+
+    import uvicorn
+    uvicorn.run("api:api", host=args.host, port=args.port, workers=args.workers)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
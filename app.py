@@ -1,53 +1,1224 @@
 
 import os
-import google.generativeai as genai
 from dotenv import load_dotenv
 import streamlit as st
-import requests
 from datetime import datetime, timedelta
-from geopy.geocoders import Nominatim
+import csv
+import heapq
+import html
+import io
+import itertools
 import json
+import logging
+import sqlite3
+import threading
+import time
+import math
+import re
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from contextlib import nullcontext, suppress
+from dataclasses import asdict, dataclass, fields
 
 # Load environment variables
 load_dotenv()
 
-# Configure the GenAI API
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-model = genai.GenerativeModel('gemini-pro')
+# The Gemini SDK, geopy, requests and numpy are imported where they are first used so the home page
+# can render without loading them; see benchmarks/startup.py
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+
+# Cache settings (seconds / number of cities)
+POPULAR_TRAILS_CACHE_TTL = int(os.getenv("POPULAR_TRAILS_CACHE_TTL", 6 * 60 * 60))
+POPULAR_TRAILS_CACHE_SIZE = int(os.getenv("POPULAR_TRAILS_CACHE_SIZE", 256))
+POPULAR_TRAILS_STORE_PATH = os.getenv("POPULAR_TRAILS_STORE_PATH", "popular_trails.sqlite3")
+# Bump when the popular-trails prompt or Trail fields change so stale pre-generated rows are ignored
+POPULAR_TRAILS_STORE_VERSION = 2
+RECOMMENDATION_CACHE_TTL = int(os.getenv("RECOMMENDATION_CACHE_TTL", 6 * 60 * 60))
+RECOMMENDATION_CACHE_SIZE = int(os.getenv("RECOMMENDATION_CACHE_SIZE", 1024))
+RECOMMENDATION_LENGTH_BAND = float(os.getenv("RECOMMENDATION_LENGTH_BAND", 2.0))
+RECOMMENDATION_ELEVATION_BAND = int(os.getenv("RECOMMENDATION_ELEVATION_BAND", 500))
+RECOMMENDATION_SIMILARITY = float(os.getenv("RECOMMENDATION_SIMILARITY", 0.85))
+CATALOG_PATH = os.getenv("CATALOG_PATH", "trail_catalog.sqlite3")
+CATALOG_RADIUS_MILES = float(os.getenv("CATALOG_RADIUS_MILES", 50))
+CATALOG_LENGTH_TOLERANCE = float(os.getenv("CATALOG_LENGTH_TOLERANCE", 2.0))
+CATALOG_ELEVATION_TOLERANCE = int(os.getenv("CATALOG_ELEVATION_TOLERANCE", 500))
+CATALOG_MAX_CANDIDATES = int(os.getenv("CATALOG_MAX_CANDIDATES", 12))
+CATALOG_MIN_CANDIDATES = int(os.getenv("CATALOG_MIN_CANDIDATES", 5))
+NOMINATIM_DOMAIN = os.getenv("NOMINATIM_DOMAIN", "nominatim.openstreetmap.org")
+NOMINATIM_SCHEME = os.getenv("NOMINATIM_SCHEME", "https")
+GEOCODE_CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", "geocode_cache.sqlite3")
+GEOCODE_NEGATIVE_TTL = int(os.getenv("GEOCODE_NEGATIVE_TTL", 24 * 60 * 60))
+GEOCODE_MIN_DELAY = float(os.getenv("GEOCODE_MIN_DELAY", 1))
+GEOCODE_WORKERS = int(os.getenv("GEOCODE_WORKERS", 4))
+GEOCODE_MAX_QUEUE = 256
+MAP_CACHE_TTL = int(os.getenv("MAP_CACHE_TTL", 6 * 60 * 60))
+MAP_CACHE_SIZE = int(os.getenv("MAP_CACHE_SIZE", 256))
+MAP_HEIGHT = int(os.getenv("MAP_HEIGHT", 400))
+WEATHER_GRID_RESOLUTION = float(os.getenv("WEATHER_GRID_RESOLUTION", 0.1))
+WEATHER_MAX_STALE = int(os.getenv("WEATHER_MAX_STALE", 3 * 60 * 60))
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", 1024))
+WEATHER_MODE = os.getenv("WEATHER_MODE", "points")
+WEATHER_HORIZON_HOURS = int(os.getenv("WEATHER_HORIZON_HOURS", 96))
+HIKING_WINDOW_HOURS = int(os.getenv("HIKING_WINDOW_HOURS", 4))
+WEATHER_PANEL_REFRESH = int(os.getenv("WEATHER_PANEL_REFRESH", 15 * 60))
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 4))
+PREFETCH_TTL = int(os.getenv("PREFETCH_TTL", 5 * 60))
+PREFETCH_CACHE_SIZE = int(os.getenv("PREFETCH_CACHE_SIZE", 256))
+METEOMATICS_BASE_URL = os.getenv("METEOMATICS_BASE_URL", "https://api.meteomatics.com")
+METEOMATICS_POOL_SIZE = int(os.getenv("METEOMATICS_POOL_SIZE", 10))
+METEOMATICS_RETRIES = int(os.getenv("METEOMATICS_RETRIES", 2))
+METEOMATICS_FORMAT = os.getenv("METEOMATICS_FORMAT", "csv")
+METEOMATICS_TIMEOUT = (float(os.getenv("METEOMATICS_CONNECT_TIMEOUT", 3.05)), float(os.getenv("METEOMATICS_READ_TIMEOUT", 10)))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 60))
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1") == "1"
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", 15))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", 1_000_000))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 4))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 32))
+BANNER_PATH = "Garibaldi-Provincial-Park-Panorama-Ridge-Overnight-Backpacking-Trip-Sunset-BANNER-1.jpg"
+BANNER_WIDTHS = tuple(int(width) for width in os.getenv("BANNER_WIDTHS", "480,960,1440").split(","))
+BANNER_MOBILE_WIDTH = int(os.getenv("BANNER_MOBILE_WIDTH", 960))
+BANNER_FORMAT = os.getenv("BANNER_FORMAT", "webp")
+BANNER_QUALITY = int(os.getenv("BANNER_QUALITY", 80))
+BANNER_VARIANTS_DIR = os.getenv("BANNER_VARIANTS_DIR", "banner_variants")
+BANNER_BUILD_RETRY = float(os.getenv("BANNER_BUILD_RETRY", 300))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_DEBUG_PANEL = os.getenv("METRICS_DEBUG_PANEL", "0") == "1"
+
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+STOPWORDS = frozenset("a an and the i we my our to of for with in on at is are be it that this some any please want would like".split())
+
+# Local bag-of-trigrams vector for free-text preferences, so paraphrases land close together
+def preference_vector(text):
+    words = sorted(set(word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOPWORDS))
+    normalized = " ".join(words)
+    return Counter(normalized[i:i + 3] for i in range(max(len(normalized) - 2, 0)))
+
+def cosine_similarity(a, b):
+    if not a and not b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    dot = sum(count * b[gram] for gram, count in a.items() if gram in b)
+    return dot / (math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values())))
+
+def preference_key(city, difficulty, length, elevation, season, pet_friendly):
+    return (
+        normalize_city(city),
+        difficulty,
+        int(length // RECOMMENDATION_LENGTH_BAND),
+        int(elevation // RECOMMENDATION_ELEVATION_BAND),
+        season,
+        bool(pet_friendly),
+    )
+
+# Recommendation results keyed by banded preferences; within a key, free text matches by similarity
+class PreferenceCache:
+    def __init__(self, maxsize, ttl, threshold, entries_per_key=8):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries_per_key = entries_per_key
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.similarity_histogram = [0] * 10
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, text, threshold=None):
+        threshold = self.threshold if threshold is None else threshold
+        vector = preference_vector(text)
+        now = time.monotonic()
+        with self._lock:
+            entries = self._data.get(key, [])
+            live = [entry for entry in entries if entry[1] > now]
+            self._size -= len(entries) - len(live)
+            best, best_similarity = None, -1.0
+            for entry_vector, _, value in live:
+                similarity = cosine_similarity(vector, entry_vector)
+                if similarity > best_similarity:
+                    best, best_similarity = value, similarity
+            if live:
+                self._data[key] = live
+                self._data.move_to_end(key)
+                self.similarity_histogram[min(int(best_similarity * 10), 9)] += 1
+            elif key in self._data:
+                del self._data[key]
+            if best is not None and best_similarity >= threshold:
+                self.hits += 1
+                return best
+            self.misses += 1
+            return None
+
+    def set(self, key, text, value):
+        with self._lock:
+            entries = self._data.setdefault(key, [])
+            entries.append((preference_vector(text), time.monotonic() + self.ttl, value))
+            self._size += 1
+            self._data.move_to_end(key)
+            if len(entries) > self.entries_per_key:
+                entries.pop(0)
+                self._size -= 1
+                self.evictions += 1
+            while self._size > self.maxsize:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "similarity_histogram": list(self.similarity_histogram),
+            }
+
+WEATHER_PARAMETERS = ("t_2m:C", "weather_symbol_1h:idx", "t_min_2m_24h:C", "t_max_2m_24h:C")
+HOURLY_WEATHER_PARAMETERS = ("t_2m:C", "weather_symbol_1h:idx", "precip_1h:mm", "wind_speed_10m:ms")
+
+# One location's forecast: shared timestamps plus one float array per Meteomatics parameter
+@dataclass(slots=True)
+class Forecast:
+    dates: list
+    series: dict
+    utc_offset: int = 0
+
+    def value(self, parameter, index, default=None):
+        import numpy as np
+        values = self.series.get(parameter)
+        if values is None or index >= len(values) or np.isnan(values[index]):
+            return default
+        return values[index].item()
+
+def decode_forecast_json(payload):
+    import numpy as np
+    locations = {}
+    for series in payload.get("data", []):
+        for coordinates in series.get("coordinates", []):
+            key = (coordinates.get("lat"), coordinates.get("lon"))
+            dates = coordinates.get("dates", [])
+            forecast = locations.setdefault(key, Forecast([date["date"] for date in dates], {}))
+            forecast.series[series["parameter"]] = np.array(
+                [np.nan if date.get("value") is None else date["value"] for date in dates], dtype=float
+            )
+    return list(locations.values())
+
+def decode_forecast_csv(text):
+    import numpy as np
+    rows = csv.reader(io.StringIO(text), delimiter=";")
+    header = next(rows, [])
+    has_location = header[:2] == ["lat", "lon"]
+    date_column = header.index("validdate")
+    parameters = header[date_column + 1:]
+
+    locations = {}
+    for row in rows:
+        if not row:
+            continue
+        key = tuple(row[:2]) if has_location else None
+        dates, values = locations.setdefault(key, ([], []))
+        dates.append(row[date_column])
+        values.append([float(value) if value else np.nan for value in row[date_column + 1:]])
+
+    forecasts = []
+    for dates, values in locations.values():
+        columns = np.array(values, dtype=float).reshape(len(values), len(parameters)).T
+        forecasts.append(Forecast(dates, dict(zip(parameters, columns))))
+    return forecasts
+
+# Forecasts keyed by grid cell, each tagged with the hour bucket it was fetched for
+class ForecastCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, cell):
+        with self._lock:
+            entry = self._data.get(cell)
+            if entry is None:
+                return None, None
+            self._data.move_to_end(cell)
+            bucket, weather_data = entry
+            return weather_data, bucket
+
+    def set(self, cell, bucket, weather_data):
+        with self._lock:
+            self._data[cell] = (bucket, weather_data)
+            self._data.move_to_end(cell)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def start_refresh(self, cell):
+        with self._lock:
+            if cell in self._refreshing:
+                return False
+            self._refreshing.add(cell)
+            return True
+
+    def finish_refresh(self, cell):
+        with self._lock:
+            self._refreshing.discard(cell)
+
+class GeocodeCache:
+    def __init__(self, path, negative_ttl):
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocode (city TEXT PRIMARY KEY, latitude REAL, longitude REAL, fetched_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS geocode_rate (id INTEGER PRIMARY KEY CHECK (id = 0), next_at REAL NOT NULL)")
+        self._conn.commit()
+
+    # Returns (found, coordinates); coordinates is None for a remembered "not found"
+    def get(self, city):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT latitude, longitude, fetched_at FROM geocode WHERE city = ?", (city,)
+            ).fetchone()
+        if row is None:
+            return False, None
+        latitude, longitude, fetched_at = row
+        if latitude is None:
+            if time.time() - fetched_at > self.negative_ttl:
+                return False, None
+            return True, None
+        return True, (latitude, longitude)
+
+    def set(self, city, coordinates):
+        latitude, longitude = coordinates if coordinates else (None, None)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geocode (city, latitude, longitude, fetched_at) VALUES (?, ?, ?, ?)",
+                (city, latitude, longitude, time.time()),
+            )
+
+    # Claims the next Nominatim request slot across every process sharing this file; returns the seconds to wait for it
+    def reserve_request(self, min_delay):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute("SELECT next_at FROM geocode_rate WHERE id = 0").fetchone()
+            now = time.time()
+            slot = max(now, row[0]) if row else now
+            self._conn.execute("INSERT OR REPLACE INTO geocode_rate (id, next_at) VALUES (0, ?)", (slot + min_delay,))
+        return slot - now
+
+# Pre-generated popular trails, written by pregenerate.py and loaded into memory when the app starts
+# Pre-generated trails are kept until regenerated; live answers shared between processes expire after shared_ttl
+class PopularTrailsStore:
+    def __init__(self, path, version, shared_ttl=0):
+        self.version = version
+        self.shared_ttl = shared_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS popular_trails (city TEXT NOT NULL, version INTEGER NOT NULL, trails TEXT NOT NULL, generated_at REAL NOT NULL, PRIMARY KEY (city, version))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared_popular_trails (city TEXT NOT NULL, version INTEGER NOT NULL, trails TEXT NOT NULL, generated_at REAL NOT NULL, PRIMARY KEY (city, version))"
+        )
+        self._conn.commit()
+        rows = self._conn.execute("SELECT city, trails FROM popular_trails WHERE version = ?", (version,)).fetchall()
+        self._trails = {city: load_trails(trails) for city, trails in rows}
+
+    def get(self, city):
+        trails = self._trails.get(city)
+        if trails is None:
+            # The batch job may have saved this city since it was loaded
+            with self._lock:
+                row = self._conn.execute("SELECT trails FROM popular_trails WHERE city = ? AND version = ?", (city, self.version)).fetchone()
+            if row is not None:
+                trails = self._trails[city] = load_trails(row[0])
+        return trails
+
+    # Returns (trails, seconds left) for a live answer from any UI or API process; trails is None once it is older than shared_ttl
+    def get_shared(self, city):
+        if not self.shared_ttl:
+            return None, 0
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT trails, generated_at FROM shared_popular_trails WHERE city = ? AND version = ? AND generated_at >= ?",
+                (city, self.version, now - self.shared_ttl),
+            ).fetchone()
+        if row is None:
+            return None, 0
+        return load_trails(row[0]), row[1] + self.shared_ttl - now
+
+    def share(self, city, trails):
+        if not self.shared_ttl:
+            return
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO shared_popular_trails (city, version, trails, generated_at) VALUES (?, ?, ?, ?)",
+                (city, self.version, dump_trails(trails), time.time()),
+            )
+            self._conn.execute("DELETE FROM shared_popular_trails WHERE generated_at < ?", (time.time() - self.shared_ttl,))
+
+    def __contains__(self, city):
+        return city in self._trails
+
+    def __len__(self):
+        return len(self._trails)
+
+    def save(self, city, trails):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO popular_trails (city, version, trails, generated_at) VALUES (?, ?, ?, ?)",
+                (city, self.version, dump_trails(trails), time.time()),
+            )
+            self._trails[city] = tuple(trails)
+
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 4
+# Cell size in degrees (latitude, longitude) at GEOHASH_PRECISION
+GEOHASH_CELL = (180 / 2 ** 10, 360 / 2 ** 10)
+
+def geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = bit = 0
+    even = True
+    while len(chars) < precision:
+        value_range, value = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            value_range[0] = mid
+        else:
+            bits = bits * 2
+            value_range[1] = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = bit = 0
+    return "".join(chars)
+
+# Every geohash cell that overlaps the bounding box of a circle around the point
+def geohash_cells(latitude, longitude, radius_miles):
+    lat_span = radius_miles / 69.0
+    lon_span = radius_miles / (69.0 * max(math.cos(math.radians(latitude)), 0.01))
+    lat_step, lon_step = GEOHASH_CELL[0] / 2, GEOHASH_CELL[1] / 2
+    cells = set()
+    lat = latitude - lat_span
+    while lat <= latitude + lat_span + lat_step:
+        lon = longitude - lon_span
+        while lon <= longitude + lon_span + lon_step:
+            cells.add(geohash(max(min(lat, 90.0), -90.0), (lon + 180.0) % 360.0 - 180.0))
+            lon += lon_step
+        lat += lat_step
+    return cells
+
+def distance_miles(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 3958.8 * 2 * math.asin(math.sqrt(a))
+
+# Local trail data with a geohash bucket index and attribute indexes, loaded with import_catalog.py
+class TrailCatalog:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS trails (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                description TEXT NOT NULL DEFAULT '',
+                difficulty TEXT NOT NULL,
+                length_miles REAL NOT NULL,
+                elevation_feet INTEGER NOT NULL,
+                pet_friendly INTEGER NOT NULL,
+                features TEXT NOT NULL DEFAULT '',
+                link TEXT NOT NULL DEFAULT '',
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                geohash TEXT NOT NULL,
+                UNIQUE (name, geohash)
+            );
+            CREATE INDEX IF NOT EXISTS trails_geohash ON trails (geohash, difficulty, length_miles);
+            CREATE INDEX IF NOT EXISTS trails_attributes ON trails (difficulty, pet_friendly, length_miles, elevation_feet);
+            """
+        )
+        self._conn.commit()
+        self.size = self._conn.execute("SELECT COUNT(*) FROM trails").fetchone()[0]
+
+    def add(self, trails):
+        rows = [
+            (
+                trail.name, trail.description, trail.difficulty, trail.length_miles, trail.elevation_feet,
+                int(bool(trail.pet_friendly)), trail.features, trail.link, trail.latitude, trail.longitude,
+                geohash(trail.latitude, trail.longitude),
+            )
+            for trail in trails
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO trails (name, description, difficulty, length_miles, elevation_feet, pet_friendly, features, link, latitude, longitude, geohash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.size = self._conn.execute("SELECT COUNT(*) FROM trails").fetchone()[0]
+
+    # Nearby trails matching the filters, best matches first; 0 length/elevation means "any"
+    def search(self, latitude, longitude, difficulty=None, length=0, elevation=0, pet_friendly=False, limit=CATALOG_MAX_CANDIDATES):
+        cells = sorted(geohash_cells(latitude, longitude, CATALOG_RADIUS_MILES))
+        query = f"SELECT name, description, difficulty, length_miles, elevation_feet, pet_friendly, features, link, latitude, longitude FROM trails WHERE geohash IN ({','.join('?' * len(cells))})"
+        params = list(cells)
+        if difficulty:
+            query += " AND difficulty = ?"
+            params.append(difficulty)
+        if pet_friendly:
+            query += " AND pet_friendly = 1"
+        if length:
+            query += " AND length_miles BETWEEN ? AND ?"
+            params += [length - CATALOG_LENGTH_TOLERANCE, length + CATALOG_LENGTH_TOLERANCE]
+        if elevation:
+            query += " AND elevation_feet BETWEEN ? AND ?"
+            params += [elevation - CATALOG_ELEVATION_TOLERANCE, elevation + CATALOG_ELEVATION_TOLERANCE]
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+
+        scored = []
+        for row in rows:
+            distance = distance_miles(latitude, longitude, row[8], row[9])
+            if distance > CATALOG_RADIUS_MILES:
+                continue
+            score = distance / CATALOG_RADIUS_MILES
+            if length:
+                score += abs(row[3] - length) / CATALOG_LENGTH_TOLERANCE
+            if elevation:
+                score += abs(row[4] - elevation) / CATALOG_ELEVATION_TOLERANCE
+            scored.append((score, row))
+        scored.sort(key=lambda item: item[0])
+        return [
+            Trail(name, description, trail_difficulty, length_miles, elevation_feet, bool(trail_pet_friendly), features, link, trail_latitude, trail_longitude)
+            for _, (name, description, trail_difficulty, length_miles, elevation_feet, trail_pet_friendly, features, link, trail_latitude, trail_longitude) in scored[:limit]
+        ]
+
+def normalize_city(city):
+    return " ".join(city.split()).casefold()
+
+DIFFICULTY_LEVELS = ("Easy", "Moderate", "Difficult")
+SEASONS = ("Spring", "Summer", "Fall", "Winter")
+MAX_LENGTH_MILES = 20.0
+MAX_ELEVATION_FEET = 2500
+
+# Histogram bucket upper bounds per metric
+METRIC_BUCKETS = {
+    "stage_duration_ms": (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000),
+    "llm_time_to_first_chunk_ms": (100, 250, 500, 1000, 2500, 5000, 10000),
+    "llm_tokens": (50, 100, 250, 500, 1000, 2500, 5000),
+    "llm_response_bytes": (256, 1024, 4096, 16384, 65536),
+    "coalesced_waiters": (0, 1, 2, 5, 10, 25, 50, 100),
+    "llm_queue_wait_ms": (1, 10, 50, 100, 500, 1000, 5000, 15000, 60000),
+}
+
+class Metrics:
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self._last_export = 0.0
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        bounds = METRIC_BUCKETS[name]
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * len(bounds), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def render_prometheus(self):
+        with self._lock:
+            items = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        lines = []
+        for name in METRIC_BUCKETS:
+            series = [(labels, histogram) for (metric_name, labels), histogram in items if metric_name == name]
+            if not series:
+                continue
+            lines.append(f"# TYPE trail_app_{name} histogram")
+            for labels, histogram in series:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                prefix = label_text + "," if label_text else ""
+                cumulative = 0
+                for bound, count in zip(METRIC_BUCKETS[name], histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f'trail_app_{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f'trail_app_{name}_bucket{{{prefix}le="+Inf"}} {histogram["count"]}')
+                lines.append(f"trail_app_{name}_sum{{{label_text}}} {histogram['sum']:.3f}")
+                lines.append(f"trail_app_{name}_count{{{label_text}}} {histogram['count']}")
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE trail_app_{name} counter")
+            for (counter_name, labels), value in counters:
+                if counter_name == name:
+                    label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                    lines.append(f"trail_app_{name}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    # Prometheus textfile-collector format, rewritten atomically at most every few seconds; a failed write waits for the next interval instead of reaching the page
+    def export(self, path, min_interval=5.0):
+        if not self._export_lock.acquire(blocking=False):
+            return
+        try:
+            now = time.monotonic()
+            if now - self._last_export < min_interval:
+                return
+            self._last_export = now
+            # Unique per process and thread, since the UI and API workers may share METRICS_FILE
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    f.write(self.render_prometheus())
+                os.replace(temp_path, path)
+            except OSError:
+                with suppress(OSError):
+                    os.remove(temp_path)
+        finally:
+            self._export_lock.release()
+
+class Span:
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        get_metrics().observe("stage_duration_ms", (time.perf_counter() - self.started) * 1000, stage=self.stage)
+        return False
+
+NULL_SPAN = nullcontext()
+
+# Times a block under a stage name; a shared no-op when metrics are off
+def span(stage):
+    return Span(stage) if METRICS_ENABLED else NULL_SPAN
+
+def record_llm_call(stage, response, started, first_chunk_at, size):
+    metrics = get_metrics()
+    metrics.observe("stage_duration_ms", (time.perf_counter() - started) * 1000, stage=stage)
+    if first_chunk_at is not None:
+        metrics.observe("llm_time_to_first_chunk_ms", (first_chunk_at - started) * 1000, stage=stage)
+    metrics.observe("llm_response_bytes", size, stage=stage)
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        metrics.observe("llm_tokens", getattr(usage, "prompt_token_count", 0) or 0, stage=stage, kind="prompt")
+        metrics.observe("llm_tokens", getattr(usage, "candidates_token_count", 0) or 0, stage=stage, kind="output")
+
+# Concurrent identical upstream calls share one in-flight request; keys start with the upstream name
+# Set on a flight whose leader stopped with nobody left to take it over; a later joiner retries instead of failing
+class AbandonedFlight(Exception):
+    pass
+
+class Flight:
+    __slots__ = ("future", "joined", "followers", "items", "streaming", "orphan")
+
+    def __init__(self):
+        self.future = Future()
+        self.joined = 0
+        self.followers = 0
+        self.items = []
+        self.streaming = False
+        # The upstream iterator of a stopped leader, waiting for a follower to carry on with it
+        self.orphan = None
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    # Returns (flight, leader); the leader makes the call and must finish() the key
+    def begin(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.joined += 1
+                flight.followers += 1
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            self.calls += 1
+            return flight, True
+
+    def finish(self, key, result=None, error=None):
+        with self._lock:
+            flight = self._flights.pop(key)
+        if METRICS_ENABLED:
+            get_metrics().observe("coalesced_waiters", flight.joined, upstream=key[0])
+        if error is not None:
+            flight.future.set_exception(error)
+        else:
+            flight.future.set_result(result)
+        with self._changed:
+            self._changed.notify_all()
+
+    def do(self, key, fn, *args):
+        flight, leader = self.begin(key)
+        if not leader:
+            try:
+                # Following rather than just waiting, so a streamed call whose leader stops is carried on here
+                for _ in self._follow(key, flight):
+                    pass
+                return flight.future.result()
+            except AbandonedFlight:
+                return self.do(key, fn, *args)
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self.finish(key, error=e if isinstance(e, Exception) else AbandonedFlight())
+            raise
+        self.finish(key, result=result)
+        return result
+
+    # The leader streams items as they arrive, and followers get each one as soon as it is published
+    def stream(self, key, make_stream):
+        flight, leader = self.begin(key)
+        if leader:
+            yield from self._relay(key, flight, iter(make_stream()))
+            return
+        try:
+            yield from self._follow(key, flight)
+        except AbandonedFlight:
+            yield from self.stream(key, make_stream)
+            return
+        # Joined a non-streamed do() call, which only has its final result
+        if not flight.streaming:
+            yield from flight.future.result()
+
+    def _relay(self, key, flight, source):
+        flight.streaming = True
+        try:
+            for item in source:
+                with self._changed:
+                    flight.items.append(item)
+                    self._changed.notify_all()
+                yield item
+        except GeneratorExit:
+            self._abandon(key, flight, source)
+            raise
+        except BaseException as e:
+            self.finish(key, error=e if isinstance(e, Exception) else AbandonedFlight())
+            raise
+        self.finish(key, result=tuple(flight.items))
+
+    # The leader's consumer stopped early: a follower carries on with the same upstream call, or it is closed if nobody is left
+    def _abandon(self, key, flight, source):
+        with self._changed:
+            if flight.followers:
+                flight.orphan = source
+                self._changed.notify_all()
+                return
+            self._flights.pop(key)
+        flight.future.set_exception(AbandonedFlight())
+        source.close()
+
+    def _follow(self, key, flight):
+        index = 0
+        following = True
+        try:
+            while True:
+                with self._changed:
+                    while index == len(flight.items) and not flight.future.done() and flight.orphan is None:
+                        self._changed.wait()
+                    items = flight.items[index:]
+                    done = flight.future.done()
+                    source, flight.orphan = flight.orphan, None
+                    if source is not None:
+                        flight.followers -= 1
+                        following = False
+                index += len(items)
+                yield from items
+                if source is not None:
+                    yield from self._relay(key, flight, source)
+                    return
+                if done:
+                    flight.future.result()
+                    return
+        finally:
+            if following:
+                with self._changed:
+                    flight.followers -= 1
+                    source, flight.orphan = (flight.orphan, None) if not flight.followers else (None, flight.orphan)
+                    if source is not None:
+                        self._flights.pop(key, None)
+                if source is not None:
+                    flight.future.set_exception(AbandonedFlight())
+                    source.close()
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "calls": self.calls, "coalesced": self.coalesced}
+
+# The text format TrailParser reads, written out once for the prompt
+TRAIL_TEXT_TEMPLATE = "\n".join(
+    [f"{field}: [{field}]" for field in ("Name", "Description", "Difficulty", "Length", "Elevation Gain", "Notable Features")]
+    + ["Trailhead: [latitude, longitude]", "AllTrails Link: [AllTrails Link]"]
+)
+RECOMMENDER_ROLE = "You are an expert in recommending hiking trails based on the city and user preferences."
+SUMMARY_INSTRUCTION = 'In "summary", briefly summarize the user\'s preferences, starting with "Here are some recommendations based on your preferences:".'
+
+# Static instructions per model call, sent as the model's system instruction so prompts carry only the request data
+SYSTEM_INSTRUCTIONS = {
+    "llm.popular_trails": (
+        "Provide the top 5 most popular and beautiful hiking trails in the given city, regardless of any specific filters.\n"
+        "Include a paragraph yet brief description of each trail with relevant emojis, its difficulty level, length, elevation gain, notable features, "
+        "the approximate trailhead latitude and longitude in decimal degrees, and the AllTrails link.\n"
+        f"Format each trail as follows, numbered Trail 1 to Trail 5:\nTrail N:\n{TRAIL_TEXT_TEMPLATE}"
+    ),
+    "llm.recommendations": (
+        f"{RECOMMENDER_ROLE}\nProvide the top 5 hiking trails for the given city that match the user's specific needs.\n{SUMMARY_INSTRUCTION}\n"
+        "For each trail give a paragraph yet brief description with relevant emojis, its difficulty level, length in miles, elevation gain in feet, "
+        "whether it is pet-friendly, notable features, the AllTrails link, and the approximate trailhead latitude and longitude."
+    ),
+    "llm.catalog_recommendations": (
+        f"{RECOMMENDER_ROLE}\nFrom the numbered candidate trails, pick the 5 that best match the user's specific needs.\n{SUMMARY_INSTRUCTION}\n"
+        "For each pick, return its candidate number, a paragraph yet brief description with relevant emojis, and its notable features."
+    ),
+    "llm.repair": (
+        "The listed hiking trails in the given city have missing or invalid fields. "
+        'For each entry, return its index and correct values for only the fields listed in "fix_fields". '
+        "Lengths are in miles, elevation gain in feet, pet_friendly is true or false, links are full AllTrails URLs."
+    ),
+    "llm.reformat": "Rewrite the given hiking trail recommendations as JSON that matches the response schema, keeping the content unchanged.",
+}
+
+PRIORITY_INTERACTIVE, PRIORITY_POPULAR, PRIORITY_BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = ("interactive", "popular", "background")
+
+class LLMOverloaded(Exception):
+    pass
+
+# Admits model calls in priority order within the RPM/TPM quota and a concurrency limit
+class LLMScheduler:
+    def __init__(self, rpm, tpm, concurrency, max_queue):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.shed = 0
+        self._requests = rpm
+        self._tokens = tpm
+        self._refilled_at = time.monotonic()
+        self._active = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    # Seconds until both buckets can cover the call
+    def _quota_wait(self, cost):
+        self._refill()
+        request_wait = max(0.0, 1 - self._requests) * 60 / self.rpm
+        token_wait = max(0.0, cost - self._tokens) * 60 / self.tpm
+        return max(request_wait, token_wait)
+
+    # Lower priorities are shed first: background at a quarter of the queue limit, popular trails at half
+    def acquire(self, priority, cost):
+        cost = min(cost, self.tpm)
+        with self._condition:
+            if len(self._queue) >= max(1, self.max_queue >> priority):
+                self.shed += 1
+                raise LLMOverloaded("Trail suggestions are busy right now. Please try again in a minute.")
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._queue, ticket)
+            started = time.monotonic()
+            while True:
+                timeout = None
+                if self._queue[0] == ticket and self._active < self.concurrency:
+                    timeout = self._quota_wait(cost)
+                    if timeout == 0:
+                        break
+                self._condition.wait(timeout)
+            heapq.heappop(self._queue)
+            self._active += 1
+            self._requests -= 1
+            self._tokens -= cost
+            self._condition.notify_all()
+        return time.monotonic() - started
+
+    # Charges the difference once the real token usage is known
+    def release(self, estimated_tokens, used_tokens=None):
+        with self._condition:
+            self._active -= 1
+            if used_tokens is not None:
+                self._tokens += estimated_tokens - used_tokens
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {"active": self._active, "queued": len(self._queue), "shed": self.shed}
+
+# Streamlit re-executes this script on every rerun, so shared state lives in cache_resource
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+@st.cache_resource
+def get_llm_scheduler():
+    return LLMScheduler(GEMINI_RPM, GEMINI_TPM, LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE)
+
+@st.cache_resource
+def get_upstream_flights():
+    return SingleFlight()
+
+@st.cache_resource
+def get_popular_trails_cache():
+    return TTLCache(POPULAR_TRAILS_CACHE_SIZE, POPULAR_TRAILS_CACHE_TTL)
+
+@st.cache_resource
+def get_popular_trails_store():
+    return PopularTrailsStore(POPULAR_TRAILS_STORE_PATH, POPULAR_TRAILS_STORE_VERSION, POPULAR_TRAILS_CACHE_TTL)
+
+@st.cache_resource
+def get_trail_catalog():
+    return TrailCatalog(CATALOG_PATH)
+
+@st.cache_resource
+def get_recommendation_cache():
+    return PreferenceCache(RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL, RECOMMENDATION_SIMILARITY)
+
+@st.cache_resource
+def get_forecast_cache():
+    return ForecastCache(WEATHER_CACHE_SIZE)
+
+@st.cache_resource
+def get_geocode_cache():
+    return GeocodeCache(GEOCODE_CACHE_PATH, GEOCODE_NEGATIVE_TTL)
+
+@st.cache_resource
+def get_prefetch_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+@st.cache_resource
+def get_prefetch_cache():
+    return TTLCache(PREFETCH_CACHE_SIZE, PREFETCH_TTL)
+
+# One Nominatim request at a time, admitted by priority so a city lookup never queues behind trail-name lookups
+@st.cache_resource
+def get_geocode_scheduler():
+    requests_per_minute = 60 / GEOCODE_MIN_DELAY if GEOCODE_MIN_DELAY > 0 else math.inf
+    return LLMScheduler(requests_per_minute, requests_per_minute, 1, GEOCODE_MAX_QUEUE)
+
+# Background trail-name lookups for the map, kept off the page path and the prefetch pool
+@st.cache_resource
+def get_geocode_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=GEOCODE_WORKERS, thread_name_prefix="geocode")
+
+@st.cache_resource
+def get_place_lookups():
+    return TTLCache(MAP_CACHE_SIZE * 8, PREFETCH_TTL)
+
+@st.cache_resource
+def get_trail_map_cache():
+    return TTLCache(MAP_CACHE_SIZE, MAP_CACHE_TTL)
+
+@st.cache_resource
+def get_model(stage):
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+    return genai.GenerativeModel(GEMINI_MODEL, system_instruction=SYSTEM_INSTRUCTIONS.get(stage))
+
+# Every model call goes through here so the timeout and metrics are applied in one place
+def generate_chunks(stage, prompt, stream=True, generation_config=None, priority=PRIORITY_INTERACTIVE):
+    scheduler = get_llm_scheduler()
+    # Roughly four characters per prompt token plus room for the answer; settled against usage_metadata afterwards
+    estimated_tokens = len(prompt) // 4 + 1024
+    try:
+        queue_wait = scheduler.acquire(priority, estimated_tokens)
+    except LLMOverloaded:
+        if METRICS_ENABLED:
+            get_metrics().increment("llm_shed_total", stage=stage, priority=PRIORITY_NAMES[priority])
+        raise
+    if METRICS_ENABLED:
+        get_metrics().observe("llm_queue_wait_ms", queue_wait * 1000, priority=PRIORITY_NAMES[priority])
+    response = None
+    try:
+        started = time.perf_counter()
+        response = get_model(stage).generate_content(
+            prompt, generation_config=generation_config, stream=stream, request_options={"timeout": LLM_TIMEOUT}
+        )
+        first_chunk_at = None
+        size = 0
+        for chunk in response if stream else [response]:
+            text = chunk.text
+            if first_chunk_at is None:
+                first_chunk_at = time.perf_counter()
+            size += len(text.encode())
+            yield text
+        if METRICS_ENABLED:
+            record_llm_call(stage, response, started, first_chunk_at, size)
+    finally:
+        usage = getattr(response, "usage_metadata", None)
+        scheduler.release(estimated_tokens, getattr(usage, "total_token_count", None) or None)
+
+def generate_text(stage, prompt, generation_config=None, priority=PRIORITY_INTERACTIVE):
+    return "".join(generate_chunks(stage, prompt, stream=False, generation_config=generation_config, priority=priority))
+
+# Keep-alive connection pool shared by every session, retrying transient failures with jittered backoff
+@st.cache_resource
+def get_weather_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.auth = (os.getenv("METEOMATICS_USERNAME"), os.getenv("METEOMATICS_PASSWORD"))
+    retry = Retry(
+        total=METEOMATICS_RETRIES,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=METEOMATICS_POOL_SIZE, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# One geocoder for every session; Nominatim's usage policy allows at most 1 request per second
+@st.cache_resource
+def get_geocoder():
+    from geopy.extra.rate_limiter import RateLimiter
+    from geopy.geocoders import Nominatim
+
+    geolocator = Nominatim(user_agent="hiking_trail_app", timeout=5, domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME)
+    return RateLimiter(geolocator.geocode, min_delay_seconds=GEOCODE_MIN_DELAY, max_retries=1, swallow_exceptions=False)
+
+# Returns (latitude, longitude), or None when the city is unknown; lookup errors are raised
+def geocode_city(city, priority=PRIORITY_INTERACTIVE):
+    cache = get_geocode_cache()
+    key = normalize_city(city)
+    found, coordinates = cache.get(key)
+    if not found:
+        coordinates = get_upstream_flights().do(("geocode", key), lookup_city, city, key, priority)
+    return coordinates
+
+def lookup_city(city, key, priority=PRIORITY_INTERACTIVE):
+    scheduler = get_geocode_scheduler()
+    scheduler.acquire(priority, 1)
+    try:
+        # The scheduler orders this process's lookups; the shared slot keeps the UI and API workers under one rate together
+        if GEOCODE_MIN_DELAY > 0:
+            time.sleep(get_geocode_cache().reserve_request(GEOCODE_MIN_DELAY))
+        with span("geocode.upstream"):
+            location = get_geocoder()(city)
+    finally:
+        scheduler.release(1)
+    coordinates = (location.latitude, location.longitude) if location else None
+    get_geocode_cache().set(key, coordinates)
+    return coordinates
 
 def get_city_coordinates(city):
-    geolocator = Nominatim(user_agent="hiking_trail_app")
     try:
-        location = geolocator.geocode(city, timeout=5)
-        if location:
-            return location.latitude, location.longitude
-        else:
-            st.warning("City not found. Please check the spelling or try another city.")
-            return None
+        with span("geocode"):
+            coordinates = geocode_city(city)
     except Exception as e:
         st.error(f"Error fetching city coordinates: {e}")
         return None
+    if coordinates:
+        return coordinates
+    else:
+        st.warning("City not found. Please check the spelling or try another city.")
+        return None
+
+# Fetches forecasts for several locations in one request; returns one payload per location, in order
+def fetch_weather_batch(locations, start):
+    base_url = METEOMATICS_BASE_URL
+
+    if WEATHER_MODE == "hourly":
+        parameters = ",".join(HOURLY_WEATHER_PARAMETERS)
+        end = start + timedelta(hours=WEATHER_HORIZON_HOURS)
+        time_range = f"{start.strftime('%Y-%m-%dT%H:%M:%SZ')}--{end.strftime('%Y-%m-%dT%H:%M:%SZ')}:PT1H"
+    else:
+        parameters = ",".join(WEATHER_PARAMETERS)
+        time_range = ",".join((start + timedelta(days=i)).strftime('%Y-%m-%dT%H:%M:%SZ') for i in range(4))
+    coordinates = "+".join(f"{latitude},{longitude}" for latitude, longitude in locations)
+    url = f"{base_url}/{time_range}/{parameters}/{coordinates}/{METEOMATICS_FORMAT}"
+
+    with span("weather.upstream"):
+        response = get_weather_session().get(url, timeout=METEOMATICS_TIMEOUT)
+    if response.status_code != 200:
+        return None
+    with span("parse"):
+        if METEOMATICS_FORMAT == "csv":
+            forecasts = decode_forecast_csv(response.text)
+        else:
+            forecasts = decode_forecast_json(response.json())
+    if len(forecasts) != len(locations):
+        return None
+    # Solar time is close enough to local time for picking calendar days and daylight hours
+    for forecast, (_, longitude) in zip(forecasts, locations):
+        forecast.utc_offset = round(longitude / 15)
+    return forecasts
+
+def fetch_weather_data(latitude, longitude, start):
+    forecasts = fetch_weather_batch([(latitude, longitude)], start)
+    return forecasts[0] if forecasts else None
+
+def weather_grid_cell(latitude, longitude):
+    cell_lat = round(round(latitude / WEATHER_GRID_RESOLUTION) * WEATHER_GRID_RESOLUTION, 4)
+    cell_lon = round(round(longitude / WEATHER_GRID_RESOLUTION) * WEATHER_GRID_RESOLUTION, 4)
+    return cell_lat, cell_lon
+
+def refresh_weather_data(cache, cells, bucket):
+    import requests
+    try:
+        forecasts = fetch_weather_batch(cells, bucket) or []
+        for cell, weather_data in zip(cells, forecasts):
+            if weather_data:
+                cache.set(cell, bucket, weather_data)
+    except requests.exceptions.RequestException:
+        pass
+    finally:
+        for cell in cells:
+            cache.finish_refresh(cell)
+
+# Quiet lookup shared by the page and the prefetcher; returns None when unavailable, request errors are raised
+def load_weather_data(latitude, longitude):
+    cell = weather_grid_cell(latitude, longitude)
+    bucket = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    cache = get_forecast_cache()
+
+    weather_data, cached_bucket = cache.get(cell)
+    if weather_data is not None:
+        if cached_bucket == bucket:
+            return weather_data
+        # Serve the previous hour's forecast right away and refresh it in the background
+        if (bucket - cached_bucket).total_seconds() <= WEATHER_MAX_STALE:
+            if cache.start_refresh(cell):
+                threading.Thread(target=refresh_weather_data, args=(cache, [cell], bucket), daemon=True).start()
+            return weather_data
+
+    return get_upstream_flights().do(("weather", cell, bucket), fetch_weather_cell, cell, bucket)
+
+def fetch_weather_cell(cell, bucket):
+    weather_data = fetch_weather_data(*cell, bucket)
+    if weather_data:
+        get_forecast_cache().set(cell, bucket, weather_data)
+    return weather_data
 
 def get_weather_data(latitude, longitude):
-    base_url = "https://api.meteomatics.com"
-    username = os.getenv("METEOMATICS_USERNAME")
-    password = os.getenv("METEOMATICS_PASSWORD")
-    
-    now = datetime.utcnow()
-    parameters = "t_2m:C,weather_symbol_1h:idx,t_min_2m_24h:C,t_max_2m_24h:C"
-    time_range = f"{now.strftime('%Y-%m-%dT%H:%M:%SZ')},{(now + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ')},{(now + timedelta(days=2)).strftime('%Y-%m-%dT%H:%M:%SZ')},{(now + timedelta(days=3)).strftime('%Y-%m-%dT%H:%M:%SZ')}"
-    url = f"{base_url}/{time_range}/{parameters}/{latitude},{longitude}/json"
-    
+    import requests
     try:
-        response = requests.get(url, auth=(username, password))
-        if response.status_code == 200:
-            return response.json()
-        else:
-            st.warning("Failed to retrieve weather data.")
-            return None
+        weather_data = load_weather_data(latitude, longitude)
     except requests.exceptions.RequestException as e:
         st.error(f"Request error: {e}")
         return None
+    if weather_data:
+        return weather_data
+    else:
+        st.warning("Failed to retrieve weather data.")
+        return None
+
+# Forecasts for many locations (e.g. every trailhead) with at most one upstream request; None where unavailable
+def get_weather_batch(locations):
+    import requests
+    bucket = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    cache = get_forecast_cache()
+    cells = [weather_grid_cell(latitude, longitude) for latitude, longitude in locations]
+
+    forecasts = {}
+    missing = []
+    stale = []
+    for cell in dict.fromkeys(cells):
+        weather_data, cached_bucket = cache.get(cell)
+        if weather_data is not None:
+            if cached_bucket == bucket:
+                forecasts[cell] = weather_data
+                continue
+            if (bucket - cached_bucket).total_seconds() <= WEATHER_MAX_STALE:
+                forecasts[cell] = weather_data
+                if cache.start_refresh(cell):
+                    stale.append(cell)
+                continue
+        missing.append(cell)
+
+    if stale:
+        threading.Thread(target=refresh_weather_data, args=(cache, stale, bucket), daemon=True).start()
+    if missing:
+        try:
+            batch = get_upstream_flights().do(("weather_batch", tuple(missing), bucket), fetch_weather_batch, missing, bucket)
+            for cell, weather_data in zip(missing, batch or []):
+                if weather_data:
+                    cache.set(cell, bucket, weather_data)
+                    forecasts[cell] = weather_data
+        except requests.exceptions.RequestException:
+            pass
+    return [forecasts.get(cell) for cell in cells]
 
 weather_emojis = {
     0: "❓",  # Unknown
@@ -65,195 +1236,1078 @@ weather_emojis = {
     12: "🌫️",  # Fog
 }
 
+HIKING_DAYLIGHT = (7, 19)
+DRY_PRECIP_MM = 0.1
+
+# Best dry daylight window of the given length for each local day: {day: (start hour, end hour)}, calmest wind wins
+def hiking_windows(forecast, hours=HIKING_WINDOW_HOURS):
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    local = np.array([date.rstrip("Z") for date in forecast.dates], dtype="datetime64[h]") + np.timedelta64(forecast.utc_offset, "h")
+    if len(local) < hours:
+        return {}
+    hour_of_day = (local - local.astype("datetime64[D]")).astype(int)
+    precip = forecast.series.get("precip_1h:mm", np.full(len(local), np.nan))
+    wind = np.nan_to_num(forecast.series.get("wind_speed_10m:ms", np.zeros(len(local))), nan=np.inf)
+    usable = (precip <= DRY_PRECIP_MM) & (hour_of_day >= HIKING_DAYLIGHT[0]) & (hour_of_day < HIKING_DAYLIGHT[1])
+    # A window is every consecutive hour usable and the series has no gaps inside it
+    contiguous = (np.diff(local).astype(int) == 1)
+    valid = sliding_window_view(usable, hours).all(axis=1)
+    if hours > 1:
+        valid &= sliding_window_view(contiguous, hours - 1).all(axis=1)
+    starts = np.flatnonzero(valid)
+    if not len(starts):
+        return {}
+    mean_wind = sliding_window_view(wind, hours).mean(axis=1)[starts]
+    days = local[starts].astype("datetime64[D]")
+    order = np.lexsort((starts, mean_wind, days))
+    _, first = np.unique(days[order], return_index=True)
+    best = starts[order[first]]
+    return {
+        str(day): (int(hour_of_day[start]), int(hour_of_day[start]) + hours)
+        for day, start in zip(local[best].astype("datetime64[D]"), best)
+    }
+
+# Daily min/max/symbol from an hourly series, grouped by local calendar day
+def summarize_hourly_forecast(forecast):
+    import numpy as np
+
+    local = np.array([date.rstrip("Z") for date in forecast.dates], dtype="datetime64[h]") + np.timedelta64(forecast.utc_offset, "h")
+    days = local.astype("datetime64[D]")
+    unique_days, starts = np.unique(days, return_index=True)
+    temperature = forecast.series.get("t_2m:C", np.full(len(local), np.nan))
+    symbols = forecast.series.get("weather_symbol_1h:idx", np.zeros(len(local)))
+    precip = np.nan_to_num(forecast.series.get("precip_1h:mm", np.zeros(len(local))))
+    with np.errstate(invalid="ignore"):
+        minimums = np.fmin.reduceat(temperature, starts)
+        maximums = np.fmax.reduceat(temperature, starts)
+    totals = np.add.reduceat(precip, starts)
+    # The symbol closest to early afternoon stands for the whole day
+    hour_of_day = (local - days).astype(int)
+    midday = np.array([start + np.argmin(np.abs(hour_of_day[start:end] - 13)) for start, end in zip(starts, [*starts[1:], len(local)])])
+    windows = hiking_windows(forecast)
+
+    current_temp = forecast.value("t_2m:C", 0, "N/A")
+    current_emoji = weather_emojis.get(int(forecast.value("weather_symbol_1h:idx", 0, 0)), "❓")
+    forecast_data = []
+    for i in range(1, min(4, len(unique_days))):
+        day = str(unique_days[i])
+        window = windows.get(day)
+        forecast_data.append({
+            "date": f"{day}T00:00:00Z",
+            "min_temp": "N/A" if np.isnan(minimums[i]) else round(minimums[i].item(), 1),
+            "max_temp": "N/A" if np.isnan(maximums[i]) else round(maximums[i].item(), 1),
+            "emoji": weather_emojis.get(int(np.nan_to_num(symbols[midday[i]])), "❓"),
+            "precip": round(totals[i].item(), 1),
+            "window": f"{window[0]:02d}:00-{window[1]:02d}:00" if window else None,
+        })
+    return current_temp, current_emoji, forecast_data
+
+def summarize_forecast(forecast):
+    if "t_min_2m_24h:C" not in forecast.series:
+        return summarize_hourly_forecast(forecast)
+
+    # Current temperature and general weather state
+    current_temp = forecast.value("t_2m:C", 0, "N/A")
+    current_emoji = weather_emojis.get(int(forecast.value("weather_symbol_1h:idx", 0, 0)), "❓")
+
+    # Weather forecast for the next 3 days
+    forecast_data = []
+    for i in range(1, min(4, len(forecast.dates))):
+        forecast_data.append({
+            "date": forecast.dates[i],
+            "min_temp": forecast.value("t_min_2m_24h:C", i, "N/A"),
+            "max_temp": forecast.value("t_max_2m_24h:C", i, "N/A"),
+            "emoji": weather_emojis.get(int(forecast.value("weather_symbol_1h:idx", i, 0)), "❓"),
+        })
+    return current_temp, current_emoji, forecast_data
+
+# Reruns on its own timer, so refreshing the forecast never re-executes the rest of the page
+@st.fragment(run_every=WEATHER_PANEL_REFRESH or None)
 def display_weather_info(city):
+    wait_for_prefetch(city, "weather")
     coordinates = get_city_coordinates(city)
     if coordinates:
         latitude, longitude = coordinates
-        weather_data = get_weather_data(latitude, longitude)
+        with span("weather"):
+            weather_data = get_weather_data(latitude, longitude)
         if weather_data:
             st.subheader(f"Weather Forecast for {city}")
 
-            # Current temperature and general weather state
-            current_temp = weather_data['data'][0]['coordinates'][0]['dates'][0]['value'] if weather_data['data'] and weather_data['data'][0]['coordinates'] else "N/A"
-            current_weather_state = weather_data['data'][1]['coordinates'][0]['dates'][0]['value'] if weather_data['data'] and weather_data['data'][1]['coordinates'] else 0
-            current_emoji = weather_emojis.get(current_weather_state, "❓")
+            current_temp, current_emoji, forecast_data = summarize_forecast(weather_data)
             st.write(f"Current Temperature: {current_temp}°C {current_emoji}")
 
-            # Weather forecast for the next 3 days
-            forecast_data = []
-            for i in range(1, 4):
-                if weather_data['data'] and weather_data['data'][0]['coordinates'] and len(weather_data['data'][0]['coordinates'][0]['dates']) > i:
-                    date = weather_data['data'][0]['coordinates'][0]['dates'][i]['date']
-                    min_temp = weather_data['data'][2]['coordinates'][0]['dates'][i]['value'] if weather_data['data'] and weather_data['data'][2]['coordinates'] else "N/A"
-                    max_temp = weather_data['data'][3]['coordinates'][0]['dates'][i]['value'] if weather_data['data'] and weather_data['data'][3]['coordinates'] else "N/A"
-                    weather_state = weather_data['data'][1]['coordinates'][0]['dates'][i]['value'] if weather_data['data'] and weather_data['data'][1]['coordinates'] else 0
-                    emoji = weather_emojis.get(weather_state, "❓")
-                    forecast_data.append({"date": date, "min_temp": min_temp, "max_temp": max_temp, "emoji": emoji})
-
             # Display weather forecast
             for day in forecast_data:
                 date = datetime.strptime(day['date'], "%Y-%m-%dT%H:%M:%SZ").strftime("%a, %b %d")
-                st.write(f"{day['emoji']} {date}: {day['min_temp']}°C - {day['max_temp']}°C")
+                details = ""
+                if "precip" in day:
+                    details = f", {day['precip']} mm rain"
+                    if day["window"]:
+                        details += f", best {HIKING_WINDOW_HOURS}h dry window {day['window']}"
+                st.write(f"{day['emoji']} {date}: {day['min_temp']}°C - {day['max_temp']}°C{details}")
         else:
             st.warning("Failed to retrieve weather data.")
     else:
         st.warning("Please enter a valid city.")
 
+def format_trail_forecast(weather_data):
+    current_temp, current_emoji, forecast_data = summarize_forecast(weather_data)
+    days = [
+        f"{day['emoji']} {datetime.strptime(day['date'], '%Y-%m-%dT%H:%M:%SZ').strftime('%a')} {day['min_temp']}°C - {day['max_temp']}°C"
+        + (f" (dry {day['window']})" if day.get("window") else "")
+        for day in forecast_data
+    ]
+    return " · ".join([f"Trailhead weather: {current_emoji} {current_temp}°C now", *days])
+
+@dataclass(slots=True)
+class Trail:
+    name: str = ""
+    description: str = ""
+    difficulty: str = ""
+    length_miles: float | None = None
+    elevation_feet: int | None = None
+    pet_friendly: bool | None = None
+    features: str = ""
+    link: str = ""
+    latitude: float | None = None
+    longitude: float | None = None
+
+NUMBER_PATTERN = re.compile(r"\d[\d,]*(?:\.\d+)?")
+URL_PATTERN = re.compile(r"https?://[^\s()\[\]<>]+")
+
+def parse_length_miles(value):
+    match = NUMBER_PATTERN.search(value)
+    if not match:
+        return None
+    miles = float(match.group().replace(",", ""))
+    unit = value[match.end():].strip().lower()
+    if unit.startswith(("km", "kilomet")):
+        miles *= 0.621371
+    return round(miles, 1)
+
+def parse_elevation_feet(value):
+    match = NUMBER_PATTERN.search(value)
+    if not match:
+        return None
+    feet = float(match.group().replace(",", ""))
+    unit = value[match.end():].strip().lower()
+    if unit.startswith("m") and not unit.startswith("mi"):
+        feet *= 3.28084
+    return round(feet)
+
+COORDINATE_PATTERN = re.compile(r"([-+]?\d+(?:\.\d+)?)\s*°?\s*([NSEW])?", re.IGNORECASE)
+
+# "47.53, -121.74" or "47.53° N, 121.74° W"; (None, None) when it is not a valid pair
+def parse_trailhead(value):
+    values = []
+    for number, hemisphere in COORDINATE_PATTERN.findall(value)[:2]:
+        values.append(-float(number) if hemisphere.upper() in ("S", "W") else float(number))
+    if len(values) < 2:
+        return None, None
+    return trailhead_coordinates({"latitude": values[0], "longitude": values[1]})
+
+def parse_pet_friendly(value):
+    value = value.strip().lower()
+    if value.startswith(("yes", "true")):
+        return True
+    if value.startswith(("no", "false")):
+        return False
+    return None
+
+# Parses model output one line at a time; a trail is complete once its AllTrails link arrives
+class TrailParser:
+    def __init__(self):
+        self._trail = None
+
+    def feed_line(self, line):
+        line = line.strip().strip("*#- ")
+        if not line:
+            return None
+        key, sep, value = line.partition(":")
+        key = key.strip("* ").lower()
+        value = value.strip("* ")
+        completed = None
+        if not sep:
+            if self._trail is not None:
+                self._trail.description = f"{self._trail.description} {line}".strip()
+            return None
+        if key.startswith("trail ") and not value:
+            completed = self._finish()
+            self._trail = Trail()
+            return completed
+        if key == "name" and self._trail is not None and self._trail.name:
+            completed = self._finish()
+        if self._trail is None:
+            self._trail = Trail()
+        trail = self._trail
+        if key == "name":
+            trail.name = value
+        elif key == "description":
+            trail.description = value
+        elif key == "difficulty":
+            trail.difficulty = value
+        elif key == "length":
+            trail.length_miles = parse_length_miles(value)
+        elif key == "elevation gain":
+            trail.elevation_feet = parse_elevation_feet(value)
+        elif key == "pet-friendly":
+            trail.pet_friendly = parse_pet_friendly(value)
+        elif key == "notable features":
+            trail.features = value
+        elif key == "trailhead":
+            trail.latitude, trail.longitude = parse_trailhead(value)
+        elif key == "alltrails link":
+            match = URL_PATTERN.search(value)
+            trail.link = match.group() if match else value
+            return self._finish()
+        return completed
+
+    def close(self):
+        return self._finish()
+
+    def _finish(self):
+        trail, self._trail = self._trail, None
+        return trail if trail is not None and trail.name else None
+
+def dump_trails(trails):
+    return json.dumps([asdict(trail) for trail in trails])
+
+def load_trails(text):
+    names = {field.name for field in fields(Trail)}
+    return tuple(Trail(**{key: value for key, value in trail.items() if key in names}) for trail in json.loads(text))
+
+def parse_trails(text):
+    parser = TrailParser()
+    with span("parse"):
+        trails = [trail for trail in map(parser.feed_line, text.split("\n")) if trail is not None]
+        last = parser.close()
+    if last is not None:
+        trails.append(last)
+    return trails
+
+class TrailStreamParser:
+    def __init__(self):
+        self._buffer = ""
+        self._parser = TrailParser()
+
+    def feed(self, text):
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split("\n")
+        return [trail for trail in map(self._parser.feed_line, lines) if trail is not None]
+
+    def close(self):
+        trails = self.feed("\n")
+        last = self._parser.close()
+        if last is not None:
+            trails.append(last)
+        return trails
+
+# Raised instead of returning no trails, so an off-format answer is shown as text and never cached
+class UnparsedResponse(Exception):
+    def __init__(self, text):
+        super().__init__("no trails could be parsed from the model response")
+        self.text = text
+
+def stream_trails(stage, prompt, priority=PRIORITY_INTERACTIVE):
+    parser = TrailStreamParser()
+    chunks = []
+    parsed = 0
+    for text in generate_chunks(stage, prompt, priority=priority):
+        chunks.append(text)
+        with span("parse"):
+            trails = parser.feed(text)
+        parsed += len(trails)
+        yield from trails
+    trails = parser.close()
+    if not parsed and not trails:
+        raise UnparsedResponse("".join(chunks))
+    yield from trails
+
+def display_trail(trail):
+    st.subheader(trail.name)
+    if trail.description:
+        st.write(trail.description)
+    if trail.difficulty:
+        st.write(f"Difficulty: {trail.difficulty}")
+    if trail.length_miles is not None:
+        st.write(f"Length: {trail.length_miles:g} miles")
+    if trail.elevation_feet is not None:
+        st.write(f"Elevation Gain: {trail.elevation_feet:,} feet")
+    if trail.pet_friendly is not None:
+        st.write(f"Pet-Friendly: {'Yes' if trail.pet_friendly else 'No'}")
+    if trail.features:
+        st.write(f"Notable Features: {trail.features}")
+    if trail.link:
+        st.write(f"[AllTrails Link]({trail.link})")
+    forecast_placeholder = st.empty()
+    st.write("---")
+    return forecast_placeholder
+
+TRAIL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "description": {"type": "string"},
+        "difficulty": {"type": "string"},
+        "length_miles": {"type": "number"},
+        "elevation_feet": {"type": "integer"},
+        "pet_friendly": {"type": "boolean"},
+        "features": {"type": "string"},
+        "link": {"type": "string"},
+        "latitude": {"type": "number"},
+        "longitude": {"type": "number"},
+    },
+    "required": ["name", "description", "difficulty", "length_miles", "elevation_feet", "pet_friendly", "features", "link"],
+}
 
+RECOMMENDATIONS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "trails": {"type": "array", "items": TRAIL_SCHEMA},
+    },
+    "required": ["summary", "trails"],
+}
 
-def generate_summary(city, difficulty, length, elevation, season, pet_friendly, user_preferences):
-    prompt = f"""
-    Generate a summary of the user's hiking trail preferences based on the following information:
-    City: {city}
-    Difficulty Level: {difficulty}
-    Trail Length: {length} miles
-    Elevation Gain: {elevation} feet
-    Season: {season}
-    Pet-Friendly: {pet_friendly}
-    User Preferences: {user_preferences}
-    Start the summary with "Here are some recommendations based on your preferences:"
-    """
-    response = model.generate_content(prompt)
-    return response.text
-
-def generate_recommendations(city, difficulty, length, elevation, season, pet_friendly, user_preferences):
-    prompt = f"""
-    You are an expert in recommending hiking trails based on the city and user preferences.
-    Provide the top 5 hiking trails for the given city that match the user's specific needs.
-    Include a paragraph yet brief description of each trail with relevant emojis, its difficulty level, length, elevation gain, notable features, and the AllTrails link.
-    Format the response as follows:
-    Trail 1:
-    Name: [Trail Name]
-    Description: [Trail Description]
-    Difficulty: [Trail Difficulty]
-    Length: [Trail Length]
-    Elevation Gain: [Elevation Gain]
-    Pet-Friendly: [pet_friendly]
-    Notable Features: [Notable Features]
-    AllTrails Link: [AllTrails Link]
-
-    ...
-
-    Trail 5:
-    Name: [Trail Name]
-    Description: [Trail Description]
-    Difficulty: [Trail Difficulty]
-    Length: [Trail Length]
-    Elevation Gain: [Elevation Gain]
-    Pet-Friendly: [pet_friendly]
-    Notable Features: [Notable Features]
-    AllTrails Link: [AllTrails Link]
-
-    City: {city}
-    Difficulty Level: {difficulty}
-    Trail Length: {length} miles
-    Elevation Gain: {elevation} feet
-    Season: {season}
-    Pet-Friendly: {pet_friendly}
-    User Preferences: {user_preferences}
-    """
-    response = model.generate_content(prompt)
-    return response.text
-
-def generate_popular_trails(city):
-    prompt = f"""
-    Provide the top 5 most popular and beautiful hiking trails in {city}, regardless of any specific filters.
-    Include a paragraph yet brief description of each trail with relevant emojis, its difficulty level, length, elevation gain, notable features, and the AllTrails link.
-    Format the response as follows:
-    Trail 1:
-    Name: [Trail Name]
-    Description: [Trail Description]
-    Difficulty: [Trail Difficulty]
-    Length: [Trail Length]
-    Elevation Gain: [Elevation Gain]
-    Notable Features: [Notable Features]
-    AllTrails Link: [AllTrails Link]
-
-    ...
-
-    Trail 5:
-    Name: [Trail Name]
-    Description: [Trail Description]
-    Difficulty: [Trail Difficulty]
-    Length: [Trail Length]
-    Elevation Gain: [Elevation Gain]
-    Notable Features: [Notable Features]
-    AllTrails Link: [AllTrails Link]
-    """
-    response = model.generate_content(prompt)
-    return response.text
-
-def home():
+CANDIDATE_RECOMMENDATIONS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "trails": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "candidate": {"type": "integer"},
+                    "description": {"type": "string"},
+                    "features": {"type": "string"},
+                },
+                "required": ["candidate", "description", "features"],
+            },
+        },
+    },
+    "required": ["summary", "trails"],
+}
+
+REPAIR_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"index": {"type": "integer"}, **TRAIL_SCHEMA["properties"]},
+        "required": ["index"],
+    },
+}
+
+def json_config(schema):
+    import google.generativeai as genai
+    return genai.GenerationConfig(response_mime_type="application/json", response_schema=schema)
+
+# Returns the names of fields that are missing or have the wrong type
+def invalid_trail_fields(trail):
+    if not isinstance(trail, dict):
+        return list(TRAIL_SCHEMA["properties"])
+    invalid = []
+    for field_name in ("name", "description", "difficulty", "features", "link"):
+        if not isinstance(trail.get(field_name), str):
+            invalid.append(field_name)
+    if not trail.get("name"):
+        invalid.append("name")
+    if not str(trail.get("link", "")).startswith("http"):
+        invalid.append("link")
+    for field_name in ("length_miles", "elevation_feet"):
+        value = trail.get(field_name)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            invalid.append(field_name)
+    if not isinstance(trail.get("pet_friendly"), bool):
+        invalid.append("pet_friendly")
+    return list(dict.fromkeys(invalid))
+
+def trailhead_coordinates(trail):
+    latitude, longitude = trail.get("latitude"), trail.get("longitude")
+    for value, limit in ((latitude, 90), (longitude, 180)):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or abs(value) > limit:
+            return None, None
+    return float(latitude), float(longitude)
+
+def trail_from_json(trail):
+    latitude, longitude = trailhead_coordinates(trail)
+    return Trail(
+        name=trail["name"],
+        description=trail["description"],
+        difficulty=trail["difficulty"],
+        length_miles=round(float(trail["length_miles"]), 1),
+        elevation_feet=round(trail["elevation_feet"]),
+        pet_friendly=trail["pet_friendly"],
+        features=trail["features"],
+        link=trail["link"],
+        latitude=latitude,
+        longitude=longitude,
+    )
+
+# Pulls the summary and each complete trail object out of a JSON response while it is still streaming
+class RecommendationStreamScanner:
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._item_start = None
+        self._key = None
+        self._expect_value = False
+
+    @property
+    def text(self):
+        return self._text
+
+    def feed(self, chunk):
+        self._text += chunk
+        events = []
+        text = self._text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1:
+                        value = json.loads(text[self._string_start:i + 1])
+                        if self._expect_value:
+                            if self._key == "summary":
+                                events.append(("summary", value))
+                            self._expect_value = False
+                        else:
+                            self._key = value
+                continue
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char == ":" and len(self._stack) == 1:
+                self._expect_value = True
+            elif char == "," and len(self._stack) == 1:
+                self._expect_value = False
+            elif char in "{[":
+                if char == "{" and self._stack == ["{", "["] and self._key == "trails":
+                    self._item_start = i
+                self._stack.append(char)
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if char == "}" and self._item_start is not None and self._stack == ["{", "["]:
+                    try:
+                        events.append(("trail", json.loads(text[self._item_start:i + 1])))
+                    except ValueError:
+                        events.append(("trail", None))
+                    self._item_start = None
+        self._pos = len(text)
+        return events
+
+def preferences_prompt(city, difficulty, length, elevation, season, pet_friendly, user_preferences):
+    return (
+        f"City: {city}\nDifficulty Level: {difficulty}\nTrail Length: {length} miles\nElevation Gain: {elevation} feet\n"
+        f"Season: {season}\nPet-Friendly: {pet_friendly}\nUser Preferences: {user_preferences}"
+    )
+
+# Written locally for cached and fallback answers, in the same opening the model is asked to use
+def preferences_summary(city, difficulty, length, elevation, season, pet_friendly, user_preferences):
+    summary = (
+        f"Here are some recommendations based on your preferences: {difficulty.lower()} trails in {city} for {season.lower()}, "
+        f"around {length:g} miles with about {elevation:,} feet of elevation gain"
+    )
+    if pet_friendly:
+        summary += ", pet-friendly"
+    user_preferences = " ".join(user_preferences.split())
+    if user_preferences:
+        summary += f", with your needs in mind: {user_preferences}"
+    return summary + "."
+
+# Asks the model to fix only the listed fields instead of regenerating the whole answer
+def repair_trails(city, broken):
+    requests_for_repair = [
+        {"index": index, "name": trail.get("name", "") if isinstance(trail, dict) else "", "fix_fields": fields}
+        for index, trail, fields in broken
+    ]
+    prompt = f"City: {city}\n{json.dumps(requests_for_repair)}"
+    text = generate_text("llm.repair", prompt, generation_config=json_config(REPAIR_SCHEMA))
+    fixes = {fix.get("index"): fix for fix in json.loads(text) if isinstance(fix, dict)}
+
+    repaired = []
+    for index, trail, fields in broken:
+        trail = dict(trail) if isinstance(trail, dict) else {}
+        fix = fixes.get(index, {})
+        for field_name in fields:
+            if field_name in fix:
+                trail[field_name] = fix[field_name]
+        if not invalid_trail_fields(trail):
+            repaired.append(trail_from_json(trail))
+    return repaired
+
+def reformat_recommendations(text):
+    return json.loads(generate_text("llm.reformat", text, generation_config=json_config(RECOMMENDATIONS_SCHEMA)))
+
+# Yields ("summary", text) and ("trail", Trail) events from a single structured model call
+def stream_recommendation_results(city, difficulty, length, elevation, season, pet_friendly, user_preferences):
+    cache = get_recommendation_cache()
+    key = preference_key(city, difficulty, length, elevation, season, pet_friendly)
+    cached = cache.get(key, user_preferences)
+    if cached is not None:
+        # The stored trails may come from similar but different inputs, so the summary is rebuilt from these ones
+        yield "summary", preferences_summary(city, difficulty, length, elevation, season, pet_friendly, user_preferences)
+        for trail in cached:
+            yield "trail", trail
+        return
+
+    leading = False
+
+    def lead():
+        nonlocal leading
+        leading = True
+        results = stream_uncached_recommendation_results(city, difficulty, length, elevation, season, pet_friendly, user_preferences)
+        return cache_recommendation_results(key, user_preferences, results)
+
+    results = get_upstream_flights().stream(("recommendations", key, " ".join(user_preferences.split()).casefold()), lead)
+    try:
+        for kind, value in results:
+            # The model's summary speaks to the leader's own inputs, which only share a band with this page's
+            if kind == "summary" and not leading:
+                value = preferences_summary(city, difficulty, length, elevation, season, pet_friendly, user_preferences)
+            yield kind, value
+    except LLMOverloaded:
+        yield from overloaded_recommendation_results(key, city, difficulty, length, elevation, season, pet_friendly, user_preferences)
+
+# Wraps a flight's upstream stream, so whichever consumer pumps it to the end is the only one writing the cache
+def cache_recommendation_results(key, user_preferences, results):
+    trails = []
+    for kind, value in results:
+        if kind == "trail":
+            trails.append(value)
+        yield kind, value
+    if trails:
+        get_recommendation_cache().set(key, user_preferences, tuple(trails))
+
+# When the model is shedding load, fall back to the closest cached answer for these filters, then to catalog matches
+def overloaded_recommendation_results(key, city, difficulty, length, elevation, season, pet_friendly, user_preferences):
+    trails = get_recommendation_cache().get(key, user_preferences, threshold=0.0)
+    if trails is None:
+        trails = catalog_candidates(city, difficulty, length, elevation, pet_friendly)[:5]
+    if not trails:
+        raise LLMOverloaded("Trail recommendations are busy right now. Please try again in a minute.")
+    yield "summary", preferences_summary(city, difficulty, length, elevation, season, pet_friendly, user_preferences)
+    for trail in trails:
+        yield "trail", trail
+
+def catalog_candidates(city, difficulty, length, elevation, pet_friendly):
+    catalog = get_trail_catalog()
+    if not catalog.size:
+        return []
+    try:
+        coordinates = geocode_city(city)
+    except Exception:
+        return []
+    if not coordinates:
+        return []
+    return catalog.search(*coordinates, difficulty=difficulty, length=length, elevation=elevation, pet_friendly=pet_friendly)
+
+def candidates_prompt(candidates, city, difficulty, length, elevation, season, pet_friendly, user_preferences):
+    listing = "\n".join(
+        f"{number}. {trail.name} | {trail.difficulty} | {trail.length_miles:g} mi | {trail.elevation_feet} ft | pets: {'yes' if trail.pet_friendly else 'no'}"
+        for number, trail in enumerate(candidates, 1)
+    )
+    return f"{listing}\n{preferences_prompt(city, difficulty, length, elevation, season, pet_friendly, user_preferences)}"
+
+# The model only ranks and describes catalog trails, so names, stats and links come from local data
+def stream_catalog_recommendation_results(candidates, city, difficulty, length, elevation, season, pet_friendly, user_preferences):
+    prompt = candidates_prompt(candidates, city, difficulty, length, elevation, season, pet_friendly, user_preferences)
+    chunks = generate_chunks("llm.catalog_recommendations", prompt, stream=LLM_STREAMING, generation_config=json_config(CANDIDATE_RECOMMENDATIONS_SCHEMA))
+    scanner = RecommendationStreamScanner()
+    picked = set()
+    for text in chunks:
+        with span("parse"):
+            events = scanner.feed(text)
+        for kind, value in events:
+            if kind == "summary":
+                yield "summary", value
+                continue
+            number = value.get("candidate") if isinstance(value, dict) else None
+            if not isinstance(number, int) or not 1 <= number <= len(candidates) or number in picked:
+                continue
+            picked.add(number)
+            candidate = candidates[number - 1]
+            description = value.get("description")
+            features = value.get("features")
+            yield "trail", Trail(
+                name=candidate.name,
+                description=description if isinstance(description, str) and description else candidate.description,
+                difficulty=candidate.difficulty,
+                length_miles=candidate.length_miles,
+                elevation_feet=candidate.elevation_feet,
+                pet_friendly=candidate.pet_friendly,
+                features=features if isinstance(features, str) and features else candidate.features,
+                link=candidate.link,
+                latitude=candidate.latitude,
+                longitude=candidate.longitude,
+            )
+    if not picked:
+        for candidate in candidates[:5]:
+            yield "trail", candidate
+
+def stream_uncached_recommendation_results(city, difficulty, length, elevation, season, pet_friendly, user_preferences):
+    candidates = catalog_candidates(city, difficulty, length, elevation, pet_friendly)
+    if len(candidates) >= CATALOG_MIN_CANDIDATES:
+        yield from stream_catalog_recommendation_results(candidates, city, difficulty, length, elevation, season, pet_friendly, user_preferences)
+        return
+
+    prompt = preferences_prompt(city, difficulty, length, elevation, season, pet_friendly, user_preferences)
+    chunks = generate_chunks("llm.recommendations", prompt, stream=LLM_STREAMING, generation_config=json_config(RECOMMENDATIONS_SCHEMA))
+    scanner = RecommendationStreamScanner()
+    has_summary = False
+    trail_count = 0
+    broken = []
+    for text in chunks:
+        with span("parse"):
+            events = scanner.feed(text)
+        for kind, value in events:
+            if kind == "summary":
+                has_summary = True
+                yield "summary", value
+                continue
+            invalid = invalid_trail_fields(value)
+            if invalid:
+                broken.append((trail_count, value, invalid))
+            else:
+                yield "trail", trail_from_json(value)
+            trail_count += 1
+
+    # Malformed JSON as a whole: reformat what the model wrote rather than asking again from scratch
+    if not has_summary or trail_count == 0:
+        try:
+            payload = json.loads(scanner.text)
+        except ValueError:
+            payload = reformat_recommendations(scanner.text)
+        if not has_summary and isinstance(payload.get("summary"), str):
+            yield "summary", payload["summary"]
+        if trail_count == 0:
+            for index, trail in enumerate(payload.get("trails") or []):
+                invalid = invalid_trail_fields(trail)
+                if invalid:
+                    broken.append((index, trail, invalid))
+                else:
+                    yield "trail", trail_from_json(trail)
+
+    if broken:
+        for trail in repair_trails(city, broken):
+            yield "trail", trail
+
+def generate_recommendation_results(city, difficulty, length, elevation, season, pet_friendly, user_preferences):
+    summary = ""
+    trails = []
+    for kind, value in stream_recommendation_results(city, difficulty, length, elevation, season, pet_friendly, user_preferences):
+        if kind == "summary":
+            summary = value
+        else:
+            trails.append(value)
+    return summary, trails
+
+def popular_trails_prompt(city):
+    return f"City: {city}"
+
+def fetch_popular_trails(city, priority=PRIORITY_POPULAR):
+    text = generate_text("llm.popular_trails", popular_trails_prompt(city), priority=priority)
+    trails = parse_trails(text)
+    if not trails:
+        raise UnparsedResponse(text)
+    return tuple(trails)
+
+# Memory cache first, then the pre-generated store, then live answers from other processes; None means a live model call is needed
+def cached_popular_trails(city):
+    cache = get_popular_trails_cache()
+    store = get_popular_trails_store()
+    key = normalize_city(city)
+    trails = cache.get(key)
+    if trails is None:
+        trails = store.get(key)
+        if trails is not None:
+            cache.set(key, trails)
+    if trails is None:
+        trails, ttl = store.get_shared(key)
+        if trails is not None:
+            cache.set(key, trails, ttl=ttl)
+    return trails
+
+# Shared through SQLite so every UI and API process benefits from one generation, but only for POPULAR_TRAILS_CACHE_TTL
+def remember_popular_trails(key, trails):
+    if trails:
+        get_popular_trails_cache().set(key, trails)
+        get_popular_trails_store().share(key, trails)
+    return trails
+
+# Runs in whichever consumer pumps the flight, so the trails are remembered once however many pages share it
+def stream_and_remember_popular_trails(city, key):
+    trails = []
+    for trail in stream_trails("llm.popular_trails", popular_trails_prompt(city), PRIORITY_POPULAR):
+        trails.append(trail)
+        yield trail
+    remember_popular_trails(key, tuple(trails))
+
+def generate_popular_trails(city, priority=PRIORITY_POPULAR):
+    trails = cached_popular_trails(city)
+    if trails is None:
+        key = normalize_city(city)
+        trails = get_upstream_flights().do(("popular_trails", key), lambda: remember_popular_trails(key, fetch_popular_trails(city, priority)))
+    return trails
+
+def stream_popular_trails(city):
+    cached = cached_popular_trails(city)
+    if cached is not None:
+        yield from cached
+        return
+    if not LLM_STREAMING:
+        yield from generate_popular_trails(city)
+        return
+
+    key = normalize_city(city)
+    # Shares the key with the prefetch and generate_popular_trails, so a page joining either gets each trail as it arrives
+    yield from get_upstream_flights().stream(("popular_trails", key), lambda: stream_and_remember_popular_trails(city, key))
+
+def prefetch_weather(city):
+    coordinates = geocode_city(city)
+    if coordinates:
+        load_weather_data(*coordinates)
+
+# Starts the lookups the next pages need while the user is still reading; the futures land in the shared caches
+def start_prefetch(city):
+    if not PREFETCH_WORKERS:
+        return
+    prefetches = get_prefetch_cache()
+    key = normalize_city(city)
+    if prefetches.get(key) is not None:
+        return
+    pool = get_prefetch_pool()
+    # Pumps the same streamed flight the popular page reads, so the page joins it rather than waiting for the whole answer
+    popular_trails = pool.submit(prefetch_popular_trails, city)
+    # The map (and folium's import) is warmed once the trails arrive; any trail-name lookups go to the geocode pool
+    popular_trails.add_done_callback(lambda future: prefetch_trail_map(city, future))
+    prefetches.set(key, {
+        "weather": pool.submit(prefetch_weather, city),
+        "popular_trails": popular_trails,
+    })
+
+def prefetch_popular_trails(city):
+    return tuple(stream_popular_trails(city))
+
+def prefetch_trail_map(city, future):
+    if not future.cancelled() and future.exception() is None and future.result():
+        get_prefetch_pool().submit(trail_map, city, future.result())
+
+# Blocks on a prefetch that is already in flight; None when there is none or it failed
+def wait_for_prefetch(city, kind):
+    if not PREFETCH_WORKERS:
+        return None
+    futures = get_prefetch_cache().get(normalize_city(city))
+    if futures is None:
+        return None
+    future = futures[kind]
+    # Still queued behind other prefetches; the page is better off making the call itself
+    if future.cancel():
+        return None
+    try:
+        return future.result()
+    except Exception:
+        return None
+
+BANNER_PLACEHOLDER_WIDTH = 32
+
+# Everything the built variants depend on; a change in any of them triggers a rebuild
+def banner_variant_settings():
+    source = os.stat(BANNER_PATH)
+    return {"source": [source.st_size, int(source.st_mtime)], "widths": list(BANNER_WIDTHS), "format": BANNER_FORMAT, "quality": BANNER_QUALITY}
+
+# Resizes and encodes every banner width plus the blurred placeholder into BANNER_VARIANTS_DIR; the manifest is written last
+def build_banner_variants():
+    from PIL import Image, ImageFilter, features
+
+    image_format = "AVIF" if BANNER_FORMAT == "avif" and features.check("avif") else "WEBP"
+    extension = image_format.lower()
+    os.makedirs(BANNER_VARIANTS_DIR, exist_ok=True)
+    heights = {}
+    for width, blur in [(width, 0) for width in BANNER_WIDTHS] + [(BANNER_PLACEHOLDER_WIDTH, 1)]:
+        with Image.open(BANNER_PATH) as source:
+            # JPEG can decode straight to the smallest scale that still covers the target width
+            source.draft("RGB", (width, width))
+            image = source.convert("RGB").resize((width, round(source.height * width / source.width)), Image.LANCZOS)
+        if blur:
+            image = image.filter(ImageFilter.GaussianBlur(blur))
+        path = os.path.join(BANNER_VARIANTS_DIR, f"{width}.{extension}")
+        image.save(f"{path}.tmp", image_format, quality=BANNER_QUALITY)
+        os.replace(f"{path}.tmp", path)
+        heights[str(width)] = image.height
+    manifest = {"settings": banner_variant_settings(), "extension": extension, "heights": heights}
+    path = os.path.join(BANNER_VARIANTS_DIR, "variants.json")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(f"{path}.tmp", path)
+    return manifest
+
+# None until variants matching the current settings exist; reading them never imports PIL
+def load_banner_manifest():
+    try:
+        with open(os.path.join(BANNER_VARIANTS_DIR, "variants.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("settings") == banner_variant_settings() else None
+
+# Builds missing variants off the page path, one build at a time; a failed build is logged and tried again after retry_after seconds
+class BannerBuild:
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        self._thread = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self._failed_at is not None and time.monotonic() - self._failed_at < self.retry_after:
+                return
+            self._thread = threading.Thread(target=self._run, name="banner_build", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            build_banner_variants()
+        except Exception:
+            self._failed_at = time.monotonic()
+            logging.getLogger(__name__).exception("Building the banner variants failed; retrying in %g seconds", self.retry_after)
+
+@st.cache_resource
+def get_banner_build():
+    return BannerBuild(BANNER_BUILD_RETRY)
+
+# Picks the smallest variant that covers the viewport; Chromium sends viewport hints only when asked, so fall back to the mobile hint
+def banner_width():
+    headers = st.context.headers
+    target = BANNER_WIDTHS[-1]
+    try:
+        viewport = float(headers.get("Sec-CH-Viewport-Width") or headers.get("Viewport-Width") or 0)
+        dpr = float(headers.get("Sec-CH-DPR") or headers.get("DPR") or 1)
+    except ValueError:
+        viewport, dpr = 0, 1
+    if viewport:
+        target = viewport * dpr
+    elif headers.get("Sec-CH-UA-Mobile") == "?1" or "Mobi" in headers.get("User-Agent", ""):
+        target = BANNER_MOBILE_WIDTH
+    return next((width for width in BANNER_WIDTHS if width >= target), BANNER_WIDTHS[-1])
+
+def read_banner_variant(manifest, width):
+    with open(os.path.join(BANNER_VARIANTS_DIR, f"{width}.{manifest['extension']}"), "rb") as f:
+        return f.read()
+
+# Inlined as a data URI so the banner paints without a second request; the blurred placeholder shows while it decodes
+@st.cache_resource
+def get_banner_html(manifest, width):
+    import base64
+
+    mimetype = f"image/{manifest['extension']}"
+    image = read_banner_variant(manifest, width)
+    placeholder = read_banner_variant(manifest, BANNER_PLACEHOLDER_WIDTH)
+    return (
+        f'<img src="data:{mimetype};base64,{base64.b64encode(image).decode()}" '
+        f'alt="Panorama Ridge at sunset, Garibaldi Provincial Park" width="{width}" height="{manifest["heights"][str(width)]}" '
+        f'style="width:100%;height:auto;background:url(data:{mimetype};base64,{base64.b64encode(placeholder).decode()}) center/cover">'
+    )
+
+# Until the variants are built, the original JPEG is served as a media file rather than inlined into every render
+def display_banner(manifest):
+    if manifest is None:
+        st.image(BANNER_PATH, width="stretch", alt="Panorama Ridge at sunset, Garibaldi Provincial Park")
+    else:
+        st.markdown(get_banner_html(manifest, banner_width()), unsafe_allow_html=True)
+
+# Queues lookups for places the model gave no coordinates for; they land in the geocode cache for a later render
+def locate_places(queries):
+    lookups = get_place_lookups()
+    for query in queries:
+        key = normalize_city(query)
+        if lookups.get(key) is None:
+            lookups.set(key, get_geocode_pool().submit(geocode_city, query, PRIORITY_BACKGROUND))
+
+# Returns (FeatureCollection, pending); trails without coordinates are placed from the geocode cache only, never waited on
+def trails_geojson(city, trails):
+    cache = get_geocode_cache()
+    features = []
+    pending = []
+    for trail in trails:
+        coordinates = (trail.latitude, trail.longitude)
+        if trail.latitude is None or trail.longitude is None:
+            query = f"{trail.name}, {city}"
+            found, coordinates = cache.get(normalize_city(query))
+            if not found:
+                pending.append(query)
+        if coordinates is None or coordinates[0] is None:
+            continue
+        latitude, longitude = coordinates
+        # Folium's tooltip and popup insert these as HTML, and the names come from the model
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+            "properties": {
+                "name": html.escape(trail.name or ""),
+                "difficulty": html.escape(trail.difficulty or ""),
+                "length": f"{trail.length_miles:g} miles" if trail.length_miles is not None else "",
+                "elevation": f"{trail.elevation_feet:,} feet" if trail.elevation_feet is not None else "",
+            },
+        })
+    if pending:
+        locate_places(pending)
+    return {"type": "FeatureCollection", "features": features}, len(pending)
+
+def render_trail_map(geojson):
+    import folium
+    from folium.plugins import MarkerCluster
+
+    trail_map = folium.Map(control_scale=True)
+    # Leaflet's cluster group unpacks the GeoJSON layer, so nearby trailheads collapse into one marker
+    cluster = MarkerCluster().add_to(trail_map)
+    folium.GeoJson(
+        geojson,
+        marker=folium.Marker(),
+        tooltip=folium.GeoJsonTooltip(["name"], labels=False),
+        popup=folium.GeoJsonPopup(["name", "difficulty", "length", "elevation"], labels=False),
+    ).add_to(cluster)
+    points = [feature["geometry"]["coordinates"] for feature in geojson["features"]]
+    trail_map.fit_bounds([[min(lat for _, lat in points), min(lon for lon, _ in points)], [max(lat for _, lat in points), max(lon for lon, _ in points)]], max_zoom=13)
+    return trail_map.get_root().render()
+
+# (GeoJSON, rendered map, trails still being located) per (city, result set); only a complete map is cached
+def trail_map(city, trails):
+    key = (normalize_city(city), tuple((trail.name, trail.latitude, trail.longitude) for trail in trails))
+    cache = get_trail_map_cache()
+    cached = cache.get(key)
+    if cached is None:
+        with span("map"):
+            geojson, pending = trails_geojson(city, trails)
+            cached = (geojson, render_trail_map(geojson) if geojson["features"] else None, pending)
+        if not pending:
+            cache.set(key, cached)
+    return cached
+
+def display_trail_map(city, trails):
+    if not trails:
+        return
+    _, map_html, pending = trail_map(city, trails)
+    if pending:
+        st.caption(f"Still locating {pending} trailhead{'s' if pending > 1 else ''}; {'they' if pending > 1 else 'it'} will be on the map next time this page loads.")
+    if not map_html:
+        return
+    if hasattr(st, "iframe"):
+        st.iframe(map_html, height=MAP_HEIGHT)
+    else:
+        import streamlit.components.v1 as components
+        components.html(map_html, height=MAP_HEIGHT)
+
+def home(banner_manifest):
     st.title("Hiking Trail Recommendations")
     
-    st.image("Garibaldi-Provincial-Park-Panorama-Ridge-Overnight-Backpacking-Trip-Sunset-BANNER-1.jpg", use_column_width=True)
+    display_banner(banner_manifest)
     
     st.write("Enter a city to get personalized hiking trail recommendations.")
     city = st.text_input("Enter the city")
     if city:
         st.session_state.city = city
+        start_prefetch(city)
         st.rerun()
 
 def display_popular_trails(city):
     st.header(f"Top 5 Popular Trails in {city}")
-    popular_trails = generate_popular_trails(city)
-    
-    trails = popular_trails.split("\n\n")
-    for trail in trails:
-        if trail.strip():
-            trail_info = trail.split("\n")
-            for info in trail_info:
-                if info.startswith("Name:"):
-                    st.subheader(info.split(": ")[1])
-                elif info.startswith("AllTrails Link:"):
-                    st.write(f"[AllTrails Link]({info.split(': ')[1]})")
-                else:
-                    st.write(info)
-            st.write("---")
+    trails = []
+    try:
+        with st.spinner("Finding popular trails..."):
+            for trail in stream_popular_trails(city):
+                trails.append(trail)
+                with st.container(), span("render"):
+                    display_trail(trail)
+    except LLMOverloaded as e:
+        st.warning(str(e))
+    except UnparsedResponse as e:
+        for line in e.text.split("\n"):
+            if line.strip():
+                st.write(line)
+    map_container = st.container()
     
     if st.button("Dismiss and Proceed to Search"):
         st.session_state.show_search_filters = True
         st.rerun()
 
+    with map_container:
+        display_trail_map(city, trails)
+
 def display_search_filters(city):
     st.header(f"Search Hiking Trails in {city}")
     
     display_weather_info(city)
     
-    difficulty = st.selectbox("Difficulty Level", ["Easy", "Moderate", "Difficult"])
-    length = st.slider("Trail Length (miles)", min_value=0.0, max_value=20.0, step=0.5)
-    elevation = st.slider("Elevation Gain (feet)", min_value=0, max_value=2500, step=100)
-    season = st.selectbox("Season", ["Spring", "Summer", "Fall", "Winter"])
-    pet_friendly = st.checkbox("Pet-Friendly")
+    # Filter changes stay in the browser until the form is submitted
+    with st.form("search_filters"):
+        difficulty = st.selectbox("Difficulty Level", DIFFICULTY_LEVELS)
+        length = st.slider("Trail Length (miles)", min_value=0.0, max_value=MAX_LENGTH_MILES, step=0.5)
+        elevation = st.slider("Elevation Gain (feet)", min_value=0, max_value=MAX_ELEVATION_FEET, step=100)
+        season = st.selectbox("Season", SEASONS)
+        pet_friendly = st.checkbox("Pet-Friendly")
+
+        user_preferences = st.text_area("Specific Needs (optional)", "")
+        submitted = st.form_submit_button("Get Recommendations")
+
+    if get_trail_catalog().size:
+        matches = catalog_candidates(city, difficulty, length, elevation, pet_friendly)
+        st.caption(f"{len(matches)} trails in the local catalog match these filters")
     
-    user_preferences = st.text_area("Specific Needs (optional)", "")
-    
-    if st.button("Get Recommendations"):
-        summary = generate_summary(city, difficulty, length, elevation, season, pet_friendly, user_preferences)
+    trails = []
+    if submitted:
+        preferences = (city, difficulty, length, elevation, season, pet_friendly, user_preferences)
         st.subheader("Summary of Your Preferences")
-        st.write(summary)
-        
-        recommendations = generate_recommendations(city, difficulty, length, elevation, season, pet_friendly, user_preferences)
+        summary_placeholder = st.empty()
         st.subheader("Recommended Hiking Trails")
-        
-        trails = recommendations.split("\n\n")
-        for trail in trails:
-            if trail.strip():
-                trail_info = trail.split("\n")
-                for info in trail_info:
-                    if info.startswith("Name:"):
-                        st.subheader(info.split(": ")[1])
-                    elif info.startswith("AllTrails Link:"):
-                        st.write(f"[AllTrails Link]({info.split(': ')[1]})")
+        located_trails = []
+        try:
+            with st.spinner("Finding trails..."):
+                for kind, value in stream_recommendation_results(*preferences):
+                    if kind == "summary":
+                        summary_placeholder.write(value)
                     else:
-                        st.write(info)
-                st.write("---")
-    
+                        trails.append(value)
+                        with st.container(), span("render"):
+                            forecast_placeholder = display_trail(value)
+                        if value.latitude is not None:
+                            located_trails.append((value, forecast_placeholder))
+        except Exception as e:
+            st.error(f"Error generating recommendations: {e}")
+
+        # One batched Meteomatics request covers every trailhead
+        if located_trails:
+            with span("weather.batch"):
+                forecasts = get_weather_batch([(trail.latitude, trail.longitude) for trail, _ in located_trails])
+            for (trail, forecast_placeholder), weather_data in zip(located_trails, forecasts):
+                if weather_data:
+                    forecast_placeholder.caption(format_trail_forecast(weather_data))
+        map_container = st.container()
+
     if st.button("Back to City Selection"):
         st.session_state.pop("city", None)
         st.session_state.pop("show_search_filters", None)
         st.rerun()
 
+    if trails:
+        with map_container:
+            display_trail_map(city, trails)
+
 def search():
     city = st.session_state.city
     
@@ -262,11 +2316,26 @@ def search():
     else:
         display_search_filters(city)
 
+def display_metrics_panel():
+    with st.sidebar.expander("Metrics"):
+        st.code(get_metrics().render_prometheus(), language="text")
+
 def main():
-    if "city" not in st.session_state:
-        home()
-    else:
-        search()
+    # Read once per run; the banner build starts from any page so the variants are ready by the next home render
+    banner_manifest = load_banner_manifest()
+    if banner_manifest is None:
+        get_banner_build().start()
+    page = "home" if "city" not in st.session_state else "search"
+    with span(f"page.{page}"):
+        if page == "home":
+            home(banner_manifest)
+        else:
+            search()
+    if METRICS_ENABLED:
+        if METRICS_FILE:
+            get_metrics().export(METRICS_FILE)
+        if METRICS_DEBUG_PANEL:
+            display_metrics_panel()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "app.py")
+
+STEPS = ("home", "popular trails", "search page", "recommendations")
+UPSTREAMS = ("gemini", "nominatim", "meteomatics")
+
+# Simulated upstream behaviour: base latency and jitter in seconds, error rate as a probability
+class Upstream:
+    def __init__(self, name, latency, jitter, error_rate):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        return random.random() >= self.error_rate
+
+def trail_text(number):
+    return (
+        f"Trail {number}:\nName: Bench Trail {number}\nDescription: A benchmark trail 🌲\nDifficulty: Moderate\n"
+        f"Length: {number + 0.5} miles\nElevation Gain: {number * 300} feet\nPet-Friendly: Yes\n"
+        f"Notable Features: views\nTrailhead: {47.5 + number / 10}, -121.8\nAllTrails Link: https://www.alltrails.com/trail/bench-{number}\n\n"
+    )
+
+def recommendations_json():
+    trails = [
+        {
+            "name": f"Bench Trail {number}", "description": "A benchmark trail 🌲", "difficulty": "Moderate",
+            "length_miles": number + 0.5, "elevation_feet": number * 300, "pet_friendly": True, "features": "views",
+            "link": f"https://www.alltrails.com/trail/bench-{number}", "latitude": 47.5 + number / 10, "longitude": -121.8,
+        }
+        for number in range(1, 6)
+    ]
+    return json.dumps({"summary": "Here are some recommendations based on your preferences: benchmark.", "trails": trails})
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+class StreamedResponse:
+    def __init__(self, chunks, upstream):
+        self.text = "".join(chunks)
+        self._chunks = chunks
+        self._upstream = upstream
+
+    def __iter__(self):
+        # Spread the simulated generation time across the chunks, like a real stream
+        delay = self._upstream.latency / max(len(self._chunks), 1)
+        for chunk in self._chunks:
+            time.sleep(delay)
+            yield Chunk(chunk)
+
+# Stand-in for google.generativeai.GenerativeModel
+def fake_model_class(upstream):
+    class FakeGenerativeModel:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def generate_content(self, prompt, stream=False, generation_config=None, **kwargs):
+            text = recommendations_json() if generation_config is not None else "".join(trail_text(n) for n in range(1, 6))
+            chunks = [text[i:i + 80] for i in range(0, len(text), 80)]
+            if stream:
+                with upstream._lock:
+                    upstream.calls += 1
+                if random.random() < upstream.error_rate:
+                    raise RuntimeError("simulated Gemini error")
+                return StreamedResponse(chunks, upstream)
+            if not upstream.hit():
+                raise RuntimeError("simulated Gemini error")
+            return Chunk(text)
+
+        def count_tokens(self, contents):
+            return type("Tokens", (), {"total_tokens": len(str(contents)) // 4})()
+
+    return FakeGenerativeModel
+
+def meteomatics_body(path, output_format):
+    times, parameters, coordinates = path.strip("/").split("/")[:3]
+    start = datetime.strptime(times.split(",")[0].split("--")[0], "%Y-%m-%dT%H:%M:%SZ")
+    if "--" in times:
+        span, step = times.split("--")[1].rsplit(":", 1)
+        end = datetime.strptime(span, "%Y-%m-%dT%H:%M:%SZ")
+        hours = int(step.strip("PTH")) or 1
+        dates = [start + timedelta(hours=h) for h in range(0, int((end - start).total_seconds() // 3600) + 1, hours)]
+    else:
+        dates = [datetime.strptime(t, "%Y-%m-%dT%H:%M:%SZ") for t in times.split(",")]
+    parameters = parameters.split(",")
+    locations = [tuple(float(v) for v in location.split(",")) for location in coordinates.split("+")]
+
+    def value(parameter, index):
+        return 3 if parameter.startswith("weather_symbol") else round(10 + 5 * random.random(), 1)
+
+    stamps = [date.strftime("%Y-%m-%dT%H:%M:%SZ") for date in dates]
+    if output_format == "json":
+        data = [
+            {"parameter": parameter, "coordinates": [
+                {"lat": lat, "lon": lon, "dates": [{"date": stamp, "value": value(parameter, i)} for i, stamp in enumerate(stamps)]}
+                for lat, lon in locations
+            ]}
+            for parameter in parameters
+        ]
+        return "application/json", json.dumps({"version": "3.0", "status": "OK", "data": data})
+    multi = len(locations) > 1
+    lines = [";".join((["lat", "lon"] if multi else []) + ["validdate"] + parameters)]
+    for lat, lon in locations:
+        for i, stamp in enumerate(stamps):
+            prefix = [str(lat), str(lon)] if multi else []
+            lines.append(";".join(prefix + [stamp] + [str(value(parameter, i)) for parameter in parameters]))
+    return "text/csv", "\n".join(lines) + "\n"
+
+def serve(handler_class):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_servers(nominatim, meteomatics):
+    class NominatimHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if not nominatim.hit():
+                self.send_error(503)
+                return
+            query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+            body = json.dumps([{"lat": "47.6062", "lon": "-122.3321", "display_name": query, "boundingbox": ["47.4", "47.7", "-122.4", "-122.2"]}])
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+    class MeteomaticsHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if not meteomatics.hit():
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            path = urlparse(self.path).path
+            output_format = path.rstrip("/").rsplit("/", 1)[-1]
+            content_type, body = meteomatics_body(path, output_format)
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body.encode())))
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+    return serve(NominatimHandler), serve(MeteomaticsHandler)
+
+def percentile(samples, pct):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+def find_button(at, label):
+    return next(button for button in at.button if button.label == label)
+
+def run_session(city, upstreams, timings, calls, errors):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=120)
+    actions = (
+        ("home", lambda: at.run()),
+        ("popular trails", lambda: at.text_input[0].input(city).run()),
+        ("search page", lambda: find_button(at, "Dismiss and Proceed to Search").click().run()),
+        ("recommendations", lambda: find_button(at, "Get Recommendations").click().run()),
+    )
+    for step, action in actions:
+        before = {name: upstream.calls for name, upstream in upstreams.items()}
+        start = time.perf_counter()
+        try:
+            action()
+        except Exception:
+            errors[step] += 1
+            return
+        timings[step].append((time.perf_counter() - start) * 1000)
+        for name, upstream in upstreams.items():
+            calls[step][name] += upstream.calls - before[name]
+        if at.exception:
+            errors[step] += 1
+
+def configure_environment(workdir, nominatim_server, meteomatics_server):
+    os.environ.update({
+        "GEMINI_API_KEY": "benchmark",
+        "METEOMATICS_USERNAME": "benchmark",
+        "METEOMATICS_PASSWORD": "benchmark",
+        "METEOMATICS_BASE_URL": f"http://127.0.0.1:{meteomatics_server.server_port}",
+        "NOMINATIM_DOMAIN": f"127.0.0.1:{nominatim_server.server_port}",
+        "NOMINATIM_SCHEME": "http",
+        "GEOCODE_CACHE_PATH": os.path.join(workdir, "geocode.sqlite3"),
+        "POPULAR_TRAILS_STORE_PATH": os.path.join(workdir, "popular.sqlite3"),
+        "CATALOG_PATH": os.path.join(workdir, "catalog.sqlite3"),
+    })
+
+def reset_caches(workdir, iteration):
+    import streamlit as st
+
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    os.environ["GEOCODE_CACHE_PATH"] = os.path.join(workdir, f"geocode-{iteration}.sqlite3")
+    os.environ["POPULAR_TRAILS_STORE_PATH"] = os.path.join(workdir, f"popular-{iteration}.sqlite3")
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end latency benchmark for the app's user flows against local stand-ins.")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--cities", default="Seattle,Portland,Vancouver", help="comma-separated cities, cycled per session")
+    parser.add_argument("--cache", choices=("cold", "warm"), default="cold", help="cold clears every cache before each session")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    for name, latency in (("gemini", 0.8), ("nominatim", 0.1), ("meteomatics", 0.15)):
+        parser.add_argument(f"--{name}-latency", type=float, default=latency)
+        parser.add_argument(f"--{name}-jitter", type=float, default=latency / 4)
+        parser.add_argument(f"--{name}-error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    upstreams = {
+        name: Upstream(name, getattr(args, f"{name}_latency"), getattr(args, f"{name}_jitter"), getattr(args, f"{name}_error_rate"))
+        for name in UPSTREAMS
+    }
+    nominatim_server, meteomatics_server = start_servers(upstreams["nominatim"], upstreams["meteomatics"])
+    workdir = tempfile.mkdtemp(prefix="trail-bench-")
+    configure_environment(workdir, nominatim_server, meteomatics_server)
+
+    timings = defaultdict(list)
+    calls = defaultdict(lambda: defaultdict(int))
+    errors = defaultdict(int)
+    cities = [city.strip() for city in args.cities.split(",") if city.strip()]
+    with mock.patch("google.generativeai.GenerativeModel", fake_model_class(upstreams["gemini"])), \
+            mock.patch("google.generativeai.configure"), \
+            mock.patch("dotenv.load_dotenv"):
+        for iteration in range(args.iterations):
+            if args.cache == "cold":
+                reset_caches(workdir, iteration)
+            run_session(cities[iteration % len(cities)], upstreams, timings, calls, errors)
+
+    results = {}
+    print(f"{args.iterations} sessions, {args.cache} caches")
+    print(f"{'step':16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}   upstream calls per action")
+    for step in STEPS:
+        samples = timings[step]
+        per_action = {name: calls[step][name] / max(len(samples), 1) for name in UPSTREAMS}
+        results[step] = {
+            "p50_ms": percentile(samples, 50),
+            "p95_ms": percentile(samples, 95),
+            "p99_ms": percentile(samples, 99),
+            "errors": errors[step],
+            "runs": len(samples),
+            "upstream_calls_per_action": per_action,
+        }
+        upstream_text = ", ".join(f"{name} {count:.2f}" for name, count in per_action.items())
+        print(
+            f"{step:16} {results[step]['p50_ms']:9.1f} {results[step]['p95_ms']:9.1f} {results[step]['p99_ms']:9.1f} "
+            f"{errors[step]:7d}   {upstream_text}"
+        )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    nominatim_server.shutdown()
+    meteomatics_server.shutdown()
+    return 1 if any(errors.values()) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def sample_prompts(app, city, preferences):
+    candidates = [
+        app.Trail(name=f"Sample Trail {number}", difficulty="Moderate", length_miles=2.5 + number, elevation_feet=300 * number, pet_friendly=number % 2 == 0)
+        for number in range(1, app.CATALOG_MAX_CANDIDATES + 1)
+    ]
+    request = (city, "Moderate", 5.0, 1000, "Summer", True, preferences)
+    return {
+        "llm.popular_trails": app.popular_trails_prompt(city),
+        "llm.recommendations": app.preferences_prompt(*request),
+        "llm.catalog_recommendations": app.candidates_prompt(candidates, *request),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Report Gemini prompt tokens per model call, split into system instruction and request data.")
+    parser.add_argument("--city", default="Seattle")
+    parser.add_argument("--preferences", default="lakes and old-growth forest, done in under 3 hours")
+    args = parser.parse_args()
+
+    import app
+
+    print(f"{'call':30} {'total':>7} {'system':>7} {'request':>8}")
+    for stage, prompt in sample_prompts(app, args.city, args.preferences).items():
+        total = app.get_model(stage).count_tokens(prompt).total_tokens
+        request = app.get_model(None).count_tokens(prompt).total_tokens
+        print(f"{stage:30} {total:7} {total - request:7} {request:8}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "app.py")
+
+# Modules the home page should not need; importing any of them there is a cold-start regression.
+# PIL is only needed to build the banner variants (build_banner.py), never to serve them.
+HEAVY_MODULES = ("google.generativeai", "geopy", "requests", "PIL")
+
+IMPORT_PROBE = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import app
+print(json.dumps({{"ms": (time.perf_counter() - start) * 1000, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+RENDER_PROBE = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+start = time.perf_counter()
+at = AppTest.from_file({app!r}, default_timeout=60).run()
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({{"ms": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules], "error": bool(at.exception)}}))
+"""
+
+def probe(code):
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def measure(code, runs):
+    samples = [probe(code) for _ in range(runs)]
+    times = [sample["ms"] for sample in samples]
+    heavy = sorted({module for sample in samples for module in sample["heavy"]})
+    errors = sum(sample.get("error", False) for sample in samples)
+    return statistics.median(times), max(times), heavy, errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure app import time and home-page time-to-first-render in fresh processes.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, help="fail if the median import time is above this")
+    parser.add_argument("--max-render-ms", type=float, help="fail if the median first render is above this")
+    args = parser.parse_args()
+
+    failures = []
+    checks = (
+        ("import app", IMPORT_PROBE.format(root=ROOT, heavy=HEAVY_MODULES), args.max_import_ms),
+        ("home first render", RENDER_PROBE.format(app=APP, heavy=HEAVY_MODULES), args.max_render_ms),
+    )
+    for name, code, limit in checks:
+        median, worst, heavy, errors = measure(code, args.runs)
+        print(f"{name:18} median {median:8.1f} ms   max {worst:8.1f} ms   heavy modules: {', '.join(heavy) or 'none'}")
+        if limit is not None and median > limit:
+            failures.append(f"{name} median {median:.1f} ms exceeds {limit:.1f} ms")
+        if heavy:
+            failures.append(f"{name} imported {', '.join(heavy)}")
+        if errors:
+            failures.append(f"{name} raised an exception in {errors} run(s)")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
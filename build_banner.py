@@ -0,0 +1,19 @@
+import argparse
+import sys
+
+import app
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the resized home banner variants ahead of time, so the app never encodes them at startup.")
+    parser.add_argument("--force", action="store_true", help="rebuild even if variants for the current settings exist")
+    args = parser.parse_args()
+
+    if not args.force and app.load_banner_manifest() is not None:
+        print(f"banner variants in {app.BANNER_VARIANTS_DIR} are up to date")
+        return 0
+    manifest = app.build_banner_variants()
+    print(f"built {len(manifest['heights'])} {manifest['extension']} variants in {app.BANNER_VARIANTS_DIR}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+import argparse
+import csv
+import sys
+
+import app
+
+def parse_row(row):
+    return app.Trail(
+        name=row["name"].strip(),
+        description=row.get("description", "").strip(),
+        difficulty=row["difficulty"].strip().capitalize(),
+        length_miles=float(row["length_miles"]),
+        elevation_feet=round(float(row["elevation_feet"])),
+        pet_friendly=app.parse_pet_friendly(row.get("pet_friendly", "")) or False,
+        features=row.get("features", "").strip(),
+        link=row.get("link", "").strip(),
+        latitude=float(row["latitude"]),
+        longitude=float(row["longitude"]),
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Import trails from a CSV file into the local trail catalog.")
+    parser.add_argument("csv_file", help="CSV with name, difficulty, length_miles, elevation_feet, pet_friendly, latitude, longitude, ... columns")
+    args = parser.parse_args()
+
+    trails = []
+    skipped = 0
+    with open(args.csv_file, newline="", encoding="utf-8") as f:
+        for line_number, row in enumerate(csv.DictReader(f), 2):
+            try:
+                trails.append(parse_row(row))
+            except (KeyError, TypeError, ValueError) as e:
+                skipped += 1
+                print(f"skipping line {line_number}: {e}")
+
+    catalog = app.TrailCatalog(app.CATALOG_PATH)
+    catalog.add(trails)
+    print(f"imported {len(trails)} trails ({skipped} skipped), catalog now has {catalog.size}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
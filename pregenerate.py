@@ -0,0 +1,70 @@
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import app
+
+# Spaces out request starts so the batch stays under the model's requests-per-minute quota
+class Throttle:
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+def read_cities(args):
+    cities = list(args.cities)
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            cities.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    unique = {}
+    for city in cities:
+        unique.setdefault(app.normalize_city(city), city)
+    return unique
+
+def generate(city, throttle):
+    throttle.wait()
+    return app.fetch_popular_trails(city, app.PRIORITY_BACKGROUND)
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-generate popular trails for a list of cities.")
+    parser.add_argument("cities", nargs="*", help="city names")
+    parser.add_argument("--file", help="text file with one city per line")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent model calls")
+    parser.add_argument("--rpm", type=float, default=app.GEMINI_RPM, help="maximum model requests per minute (default: GEMINI_RPM)")
+    parser.add_argument("--force", action="store_true", help="regenerate cities that are already stored")
+    args = parser.parse_args()
+
+    store = app.PopularTrailsStore(app.POPULAR_TRAILS_STORE_PATH, app.POPULAR_TRAILS_STORE_VERSION)
+    cities = read_cities(args)
+    todo = {key: city for key, city in cities.items() if args.force or key not in store}
+    print(f"{len(cities)} cities, {len(cities) - len(todo)} already stored, generating {len(todo)}")
+
+    throttle = Throttle(args.rpm)
+    failures = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(generate, city, throttle): key for key, city in todo.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                trails = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"FAILED {todo[key]}: {e}")
+                continue
+            store.save(key, trails)
+            print(f"ok {todo[key]} ({len(trails)} trails)")
+
+    print(f"done: {len(todo) - failures} generated, {failures} failed")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())